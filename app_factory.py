@@ -0,0 +1,114 @@
+"""Builds the Flask app: `create_app()` for the roles a process serves.
+
+`spotifyAccessTest.py` runs it under the development server and `wsgi.py` is
+the entry point for gunicorn (settings in `gunicorn.conf.py`).
+"""
+from dotenv import load_dotenv
+import importlib
+import os
+from flask import Flask, Response, request
+from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Load .env before importing our modules; they read their settings at import time
+load_dotenv()
+
+import db
+import metrics
+
+# Route groups a process can serve, each in its own module. A module is only
+# imported when its role is served, so an audio-only process never loads the
+# emotion model (or TensorFlow) and starts in well under a second.
+ROLE_MODULES = {
+    'inference': 'inference_routes',
+    'download': 'download_routes',
+    'audio': 'audio_routes',
+}
+# Photo requests pick and download songs in-process, and their async answers
+# point at /jobs/*, so inference always comes with the download routes
+ROLE_REQUIRES = {'inference': ('download',)}
+# Comma-separated roles served by the module-level `app` (default: all of them)
+APP_ROLES = os.getenv('APP_ROLES', ','.join(ROLE_MODULES))
+
+
+def parse_roles(roles):
+    """Normalise a comma-separated string or iterable of role names, adding required roles."""
+    if isinstance(roles, str):
+        roles = roles.split(',')
+    wanted = [r.strip() for r in roles if r and r.strip()]
+    unknown = [r for r in wanted if r not in ROLE_MODULES]
+    if unknown:
+        raise ValueError(f"unknown roles: {', '.join(unknown)} (expected {', '.join(ROLE_MODULES)})")
+    for role in list(wanted):
+        wanted.extend(ROLE_REQUIRES.get(role, ()))
+    return tuple(r for r in ROLE_MODULES if r in wanted)
+
+
+def _start_timing():
+    metrics.begin_request()
+
+
+def _finish_timing(response):
+    total, timings = metrics.end_request()
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.request_seconds.observe(total, endpoint, request.method, str(response.status_code))
+    response.headers['Server-Timing'] = metrics.server_timing(total, timings)
+    # Lets browser devtools on other origins (the Vite front end) show the breakdown
+    response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def index():
+    return "Welcome to the Spotify Song Downloader API! This is not something you can use as a website, leave and let code do the rest.  Use the /get_song endpoint to download a song. HWGI"
+
+
+def create_app(roles=None, start_background=True):
+    """Build the app for `roles` (see ROLE_MODULES; default APP_ROLES).
+
+    With `start_background` the roles' background work starts right away:
+    model warm-up (inference), the emotion pool keeper (download) and the
+    catalog reconciler (audio). Pass False when a process manager starts it
+    later, e.g. after forking workers.
+    """
+    roles = parse_roles(APP_ROLES if roles is None else roles)
+    app = Flask(__name__)
+    # Trust proxy headers from nginx so request.url_root reflects the public ngrok URL
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1, x_prefix=1)
+
+    CORS(app)  # allow all origins
+
+    app.before_request(_start_timing)
+    app.after_request(_finish_timing)
+    app.add_url_rule('/metrics', view_func=prometheus_metrics)
+    app.add_url_rule('/secondaryfornow', view_func=index)
+
+    # Bring songs.db up to the current schema once, before any request touches it
+    db.migrate()
+
+    for role in roles:
+        module = importlib.import_module(ROLE_MODULES[role])
+        app.register_blueprint(module.bp)
+        if start_background:
+            module.start_background()
+    app.config['ROLES'] = roles
+    print(f"[app] serving roles: {', '.join(roles)}")
+    return app
+
+
+def preload(roles=None):
+    """Load what the roles' workers share before a pre-forking server forks them."""
+    roles = parse_roles(APP_ROLES if roles is None else roles)
+    if 'inference' in roles:
+        import emotion_model
+        emotion_model.preload()
+
+
+def start_background(roles=None):
+    """Start the background work of `roles`; for apps built with start_background=False."""
+    for role in parse_roles(APP_ROLES if roles is None else roles):
+        importlib.import_module(ROLE_MODULES[role]).start_background()
+
@@ -0,0 +1,376 @@
+"""ASGI entry point: `uvicorn asgi:app` (or gunicorn with uvicorn workers).
+
+`POST /`, `POST /request_song`, `GET /songs` and `GET /songs/<path>` are
+served here on asyncio, with the Flask routes' request and response contract.
+Spotify is called through spotify_async, spotdl runs as an asyncio
+subprocess and audio files are read asynchronously, so a request waiting on
+any of them holds no thread and one process keeps thousands of them open.
+Photo decoding and emotion inference, which are CPU-bound, run on their own
+ASGI_INFERENCE_WORKERS thread pool.
+
+Every other route (/jobs/*, /renditions, /stats/*, /ready, /frames,
+/metrics, ...) is answered by the Flask app itself, mounted underneath, so
+async answers that point at /jobs/* keep working. Like the Flask app, a
+process only serves, and only imports the modules of, the roles in APP_ROLES.
+"""
+import asyncio
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from fastapi import FastAPI, Request
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from werkzeug.http import generate_etag, parse_etags
+from werkzeug.security import safe_join
+
+import app_factory
+import audio_store
+import db
+import downloads
+import library
+import metrics
+from asgi_audio import json_response, send_audio
+
+with warnings.catch_warnings():
+    # Deprecated in favour of a2wsgi, which is not a dependency; it is only the fallback here
+    warnings.simplefilter('ignore', DeprecationWarning)
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+# Threads decoding photos and running the emotion model; faces from concurrent
+# requests still meet in the model's micro-batcher
+ASGI_INFERENCE_WORKERS = int(os.getenv('ASGI_INFERENCE_WORKERS', str(min(8, os.cpu_count() or 1))))
+
+flask_app = app_factory.create_app(start_background=False)
+ROLES = flask_app.config['ROLES']
+
+# Per-role imports, as app_factory.ROLE_MODULES: an audio-only process never
+# loads the emotion model, and a tier without 'download' never talks to Spotify
+if 'inference' in ROLES:
+    import frame_cache
+    import pool_keeper
+    from frames import decode_photo, parse_face_box
+if 'download' in ROLES:
+    import jobs
+    import progressive
+    import spotify_client
+    import track_selection
+    from spotify_async import SpotifyAsync
+    from track_responses import MAX_JOB_WAIT_S, set_track_headers
+if 'audio' in ROLES:
+    import transcode
+    from audio_routes import IMMUTABLE_MAX_AGE_S, listing_page, parse_listing_args
+
+_inference_pool = ThreadPoolExecutor(max_workers=ASGI_INFERENCE_WORKERS, thread_name_prefix='asgi-inference')
+_spotify = None
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global _spotify
+    if 'download' in ROLES:
+        _spotify = SpotifyAsync()
+    app_factory.start_background(ROLES)
+    try:
+        yield
+    finally:
+        if _spotify is not None:
+            await _spotify.aclose()
+        _inference_pool.shutdown(wait=False)
+
+
+class ServerTiming:
+    """Stage timings and Server-Timing headers for the routes served here (Flask times its own)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        metrics.begin_request()
+
+        async def send_with_timing(message):
+            # Only APIRoute puts 'route' in the scope; mounted Flask requests pass through
+            route = scope.get('route')
+            if message['type'] == 'http.response.start' and route is not None:
+                total, timings = metrics.end_request()
+                metrics.request_seconds.observe(total, route.path, scope['method'], str(message['status']))
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', metrics.server_timing(total, timings).encode('latin-1')))
+                headers.append((b'timing-allow-origin', b'*'))
+                message = {**message, 'headers': headers}
+            await send(message)
+        await self.app(scope, receive, send_with_timing)
+
+
+def _forwarded(request, name):
+    value = request.headers.get(name)
+    return value.split(',')[-1].strip() if value else None
+
+
+def url_root(request):
+    """Flask's `request.url_root` behind ProxyFix(x_proto=1, x_host=1, x_prefix=1)."""
+    scheme = _forwarded(request, 'X-Forwarded-Proto') or request.url.scheme
+    host = _forwarded(request, 'X-Forwarded-Host') or request.headers.get('host') or request.url.netloc
+    prefix = (_forwarded(request, 'X-Forwarded-Prefix') or '').rstrip('/') + request.scope.get('root_path', '')
+    return f"{scheme}://{host}{prefix}/"
+
+
+def _in_inference_pool(fn, *args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(_inference_pool, partial(fn, *args, **kwargs))
+
+
+# --- shared answers (see track_responses.py for the Flask versions) ---------------
+
+def _wants_async(request):
+    return request.headers.get('X-Async') == '1' or request.query_params.get('async') == '1'
+
+
+def _wants_progressive(request):
+    return request.headers.get('X-Progressive') == '1' or request.query_params.get('progressive') == '1'
+
+
+def _queue_download(request, track, search_query, extra=None, emotion=None):
+    job = jobs.job_queue.submit(track, search_query, emotion=emotion)
+    root = url_root(request).rstrip('/')
+    body = job.to_dict()
+    body.update({
+        'status_url': f"{root}/jobs/{job.id}",
+        'events_url': f"{root}/jobs/{job.id}/events",
+        'audio_url': f"{root}/jobs/{job.id}/audio",
+    })
+    body.update(extra or {})
+    return json_response(body, 202, {'Location': body['status_url']})
+
+
+async def _audio_response(request, track, audio_path, extra_headers=None, download_name=None):
+    await asyncio.to_thread(library.library.record_access, audio_path, request.headers.get('Range'))
+    try:
+        response = await send_audio(request, audio_path, download_name or os.path.basename(audio_path))
+        set_track_headers(response, track, extra_headers or {})
+        return response
+    except Exception as e:
+        print(f"[serve_audio_in_post] error: {e}")
+        return json_response({'error': 'failed to stream audio', 'details': str(e)}, 500)
+
+
+async def _progressive_response(request, track, job, extra_headers=None):
+    extra_headers = {**(extra_headers or {}), 'X-Job-Id': job.id}
+    if not await asyncio.to_thread(progressive.wait_until_streamable, job, MAX_JOB_WAIT_S):
+        location = f"{url_root(request).rstrip('/')}/jobs/{job.id}/audio"
+        return json_response(job.to_dict(), 202, {'Retry-After': '2', 'Location': location})
+    if job.state == jobs.FAILED:
+        return json_response(job.to_dict(), 500)
+    if job.state == jobs.READY:
+        return await _audio_response(request, track, job.result['audio_path'], extra_headers,
+                                     job.result['display_name'])
+    # The tail of a growing file is read by a blocking generator, which Starlette runs on its threads
+    response = StreamingResponse(progressive.stream_job(job), media_type='audio/mpeg', headers={
+        'Cache-Control': 'no-store',
+        'Accept-Ranges': 'none',
+        'X-Accel-Buffering': 'no',
+        'Content-Disposition': f'inline; filename="{downloads.track_filename(track)}"',
+    })
+    set_track_headers(response, track, extra_headers)
+    return response
+
+
+async def _fetch(track, search_query, emotion=None):
+    """Returns (result, error) like track_responses.fetch_via_queue."""
+    try:
+        with metrics.timed('download_wait'):
+            return await downloads.fetch_track_async(track, search_query, emotion=emotion), None
+    except downloads.DownloadError as e:
+        return None, str(e)
+    except Exception as e:
+        return None, f"Unexpected download error: {e}"
+
+
+async def _respond_with_track(request, track, result, extra, extra_headers):
+    if request.headers.get('X-Return-Audio') == '1' and os.path.exists(result['audio_path']):
+        return await _audio_response(request, track, result['audio_path'], extra_headers, result['display_name'])
+    body = await asyncio.to_thread(downloads.build_response, track, result, url_root(request))
+    return json_response({**body, **extra})
+
+
+# --- routes ------------------------------------------------------------------------
+
+async def get_song(request: Request):
+    form = await request.form()
+    photo = form.get('photo')
+    if photo is None or isinstance(photo, str):
+        return json_response({'error': 'photo file is required'}, 400)
+
+    # Optional "x,y,w,h" face box from the client, in original image pixels
+    face_box = parse_face_box(form.get('face_box') or request.query_params.get('face_box'))
+    data = await photo.read()
+    with metrics.timed('decode'):
+        frame, preprocess = await _in_inference_pool(decode_photo, data, face_box=face_box)
+    print(f"[preprocess] original={preprocess['original_size']} reduction={preprocess['reduction']} inference={preprocess['inference_size']} cropped={preprocess['cropped']}")
+    if frame is None:
+        return json_response({'error': 'photo could not be decoded as an image', 'preprocess': preprocess}, 400)
+    with metrics.timed('inference'):
+        emotion, cache_hit = await _in_inference_pool(frame_cache.detect_emotion, frame, cropped=preprocess['cropped'])
+    if emotion.startswith("Error"):
+        return json_response({'error': emotion}, 500)
+    inference_size = 'x'.join(str(v) for v in preprocess['inference_size'])
+    return await _song_for_emotion(
+        request,
+        emotion,
+        extra={'emotion': emotion, 'preprocess': preprocess, 'emotion_cached': cache_hit},
+        extra_headers={'X-Inference-Size': inference_size, 'X-Emotion-Cache': 'hit' if cache_hit else 'miss'},
+    )
+
+
+async def _song_for_emotion(request, emotion, extra, extra_headers):
+    search_query = emotion
+    # Serve a pre-downloaded track when the pool has one; the keeper replaces it
+    if pool_keeper.EMOTION_POOL_ENABLED:
+        with metrics.timed('pool_claim'):
+            claimed = await asyncio.to_thread(downloads.claim_pooled, emotion)
+        if claimed is not None:
+            pool_keeper.pool_keeper.request_refill(emotion)
+            track, result = claimed
+            track_selection.mark_played(track['id'])
+            return await _respond_with_track(request, track, result, extra, extra_headers)
+
+    if not spotify_client.credentials_configured():
+        return json_response({'error': 'Server Spotify credentials not configured.'}, 500)
+
+    try:
+        with metrics.timed('selection'):
+            track = await _spotify.pick_track(search_query)
+    except track_selection.SelectionError as e:
+        return json_response({'error': str(e)}, e.status)
+    except Exception as e:
+        return json_response({'error': f'Spotify search failed: {e}'}, 500)
+
+    if _wants_async(request):
+        return _queue_download(request, track, search_query, extra, emotion=emotion)
+
+    # Start sending audio while spotdl is still writing the file
+    if request.headers.get('X-Return-Audio') == '1' and _wants_progressive(request):
+        job = jobs.job_queue.submit(track, search_query, emotion=emotion)
+        return await _progressive_response(request, track, job, extra_headers)
+
+    result, error = await _fetch(track, search_query, emotion=emotion)
+    if error:
+        return json_response({'error': error}, 500)
+    return await _respond_with_track(request, track, result, extra, extra_headers)
+
+
+async def request_song(request: Request):
+    """Async `download_routes.request_song`: a song by `title` and/or `artist`."""
+    if request.headers.get('content-type', '').split(';')[0].strip().endswith(('/json', '+json')):
+        try:
+            data = await request.json() or {}
+        except ValueError:
+            return json_response({'error': 'Request body is not valid JSON.'}, 400)
+    else:
+        data = dict(await request.form()) or dict(request.query_params)
+
+    title = (data.get('title') or request.query_params.get('title') or '').strip()
+    artist = (data.get('artist') or request.query_params.get('artist') or '').strip()
+    if not title and not artist:
+        return json_response({'error': 'Provide at least `title` or `artist` parameter.'}, 400)
+
+    if not spotify_client.credentials_configured():
+        return json_response({'error': 'Server Spotify credentials not configured.'}, 500)
+
+    # Build a targeted search query. Use Spotify advanced search fields for best match.
+    q_parts = []
+    if title:
+        q_parts.append(f'track:{title}')
+    if artist:
+        q_parts.append(f'artist:{artist}')
+    q = ' '.join(q_parts)
+
+    try:
+        results = await _spotify.search(q, type='track', limit=10)
+        tracks = results.get('tracks', {}).get('items', [])
+    except Exception as e:
+        return json_response({'error': f'Spotify search failed: {e}'}, 500)
+
+    if not tracks:
+        return json_response({'error': 'No matching tracks found'}, 404)
+
+    # Prefer exact-ish matches; for now take the first result
+    track = tracks[0]
+
+    if _wants_async(request):
+        return _queue_download(request, track, q)
+
+    result, error = await _fetch(track, q)
+    if error:
+        return json_response({'error': error}, 500)
+    body = await asyncio.to_thread(downloads.build_response, track, result, url_root(request))
+    return json_response(body)
+
+
+async def serve_song(request: Request):
+    """Async `audio_routes.serve_song`."""
+    filename = request.path_params['filename']
+    full_path = safe_join(audio_store.SONGS_DIR, filename)
+    print(f"[serve_song] requested: {filename}; full_path={full_path}")
+    if full_path is None or not await asyncio.to_thread(os.path.isfile, full_path):
+        print(f"[serve_song] file not found: {full_path}")
+        return json_response({'error': 'file not found'}, 404)
+    if request.headers.get('Range'):
+        print(f"[serve_song] Range header: {request.headers['Range']}")
+
+    download_name = os.path.basename(filename)
+    mimetype = transcode.mimetype_for(filename)
+    immutable = audio_store.is_content_key(filename) or audio_store.is_variant_key(filename)
+    if audio_store.is_content_key(filename):
+        # Content-addressed paths never change bytes; name the download after the track
+        with metrics.timed('db'):
+            row = await asyncio.to_thread(db.get_song_by_path, filename)
+        if row is not None:
+            download_name = downloads.track_filename({'name': row['name'], 'artists': [{'name': row['artist']}]})
+    await asyncio.to_thread(library.library.record_access, filename, request.headers.get('Range'))
+    try:
+        with metrics.timed('send'):
+            if immutable:
+                return await send_audio(request, full_path, download_name, mimetype=mimetype,
+                                        max_age=IMMUTABLE_MAX_AGE_S, immutable=True)
+            return await send_audio(request, full_path, download_name, mimetype=mimetype)
+    except Exception as e:
+        print(f"[serve_song] error sending file: {e}")
+        return json_response({'error': 'failed to send file', 'details': str(e)}, 500)
+
+
+async def list_songs(request: Request):
+    """Async `audio_routes.list_songs`: same query parameters, body and ETag."""
+    try:
+        limit, filters, fields = parse_listing_args(request.query_params)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    rows = await asyncio.to_thread(db.list_songs, limit, **filters)
+    response = json_response(listing_page(rows, limit, fields, url_root(request)))
+    etag = generate_etag(response.body)
+    response.headers['ETag'] = f'"{etag}"'
+    if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        return Response(status_code=304, headers={'ETag': f'"{etag}"'})
+    return response
+
+
+def create_asgi_app():
+    asgi_app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+    asgi_app.add_middleware(ServerTiming)
+    # allow all origins, like CORS(app) on the Flask side
+    asgi_app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    if 'inference' in ROLES:
+        asgi_app.add_api_route('/', get_song, methods=['POST'])
+    if 'download' in ROLES:
+        asgi_app.add_api_route('/request_song', request_song, methods=['POST'])
+    if 'audio' in ROLES:
+        asgi_app.add_api_route('/songs', list_songs, methods=['GET'])
+        asgi_app.add_api_route('/songs/{filename:path}', serve_song, methods=['GET'])
+    asgi_app.mount('/', WSGIMiddleware(flask_app))
+    return asgi_app
+
+
+app = create_asgi_app()
@@ -0,0 +1,110 @@
+"""Responses for the ASGI app (asgi.py): JSON bodies and audio files.
+
+`send_audio` answers like audio_serving.send_audio does for Flask: the same
+validators, conditional requests, single and multipart byte ranges, caching
+headers and error bodies. The file is read in CHUNK_SIZE pieces through
+anyio's thread-backed file API, so a slow client holds no thread while its
+body drains.
+"""
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import anyio
+from starlette.responses import Response, StreamingResponse
+from werkzeug.http import http_date, is_resource_modified, parse_if_range_header, parse_range_header, quote_etag
+
+from audio_serving import (
+    CHUNK_SIZE, file_etag, if_range_matches, multi_range_spans, multipart_framing, too_many_ranges,
+)
+
+
+def json_response(body, status=200, headers=None):
+    """Same bytes as Flask's `jsonify` outside debug mode (compact, sorted keys)."""
+    content = json.dumps(body, ensure_ascii=True, sort_keys=True, separators=(',', ':')) + '\n'
+    return Response(content, status_code=status, headers=headers, media_type='application/json')
+
+
+def _environ(request):
+    # werkzeug's conditional-request helpers read headers from a WSGI environ
+    environ = {'REQUEST_METHOD': request.method}
+    for name, value in request.headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+async def _file_body(path, spans, part_headers=None, closing=b''):
+    async with await anyio.open_file(path, 'rb') as fh:
+        for i, (start, stop) in enumerate(spans):
+            if part_headers:
+                yield part_headers[i]
+            await fh.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = await fh.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    if closing:
+        yield closing
+
+
+def _unsatisfiable(message, size):
+    return json_response({'error': message}, 416, {'Content-Range': f'bytes */{size}'})
+
+
+async def send_audio(request, path, download_name, mimetype='audio/mpeg', max_age=None, immutable=False):
+    """Response for an audio file, honouring Range and conditional headers.
+
+    `immutable` marks the response cacheable forever (for content-addressed paths).
+    """
+    st = await anyio.to_thread.run_sync(os.stat, path)
+    size = st.st_size
+    etag = file_etag(st)
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Access-Control-Allow-Origin': '*',
+        'Content-Disposition': f'inline; filename="{download_name}"',
+    }
+    cache_control = [f'public, max-age={max_age}'] if max_age else ['no-cache']
+    if max_age:
+        headers['Expires'] = http_date(time.time() + max_age)
+    if immutable:
+        cache_control.append('immutable')
+    headers['Cache-Control'] = ', '.join(cache_control)
+
+    modified_at = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    if not is_resource_modified(_environ(request), etag=etag, last_modified=modified_at):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('Range')
+    parsed = parse_range_header(range_header) if range_header else None
+    # Too many ranges for a multipart answer: ignore the header and send the whole file
+    if range_header and not too_many_ranges(parsed) and if_range_matches(
+            parse_if_range_header(request.headers.get('If-Range')), 'If-Range' in request.headers,
+            etag, st.st_mtime):
+        spans = multi_range_spans(parsed, size)
+        if spans == []:
+            return _unsatisfiable('Range not satisfiable', size)
+        if spans:
+            content_type, part_headers, closing, length = multipart_framing(spans, size, mimetype)
+            headers['Content-Length'] = str(length)
+            return StreamingResponse(_file_body(path, spans, part_headers, closing), 206,
+                                     headers=headers, media_type=content_type)
+        if size:
+            # Like werkzeug: a Range header that is malformed or unsatisfiable is
+            # refused rather than ignored
+            span = parsed.range_for_length(size) if parsed is not None else None
+            if span is None:
+                return _unsatisfiable('Range start out of bounds', size)
+            start, stop = span
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            headers['Content-Length'] = str(stop - start)
+            return StreamingResponse(_file_body(path, [span]), 206, headers=headers, media_type=mimetype)
+
+    headers['Content-Length'] = str(size)
+    return StreamingResponse(_file_body(path, [(0, size)]), 200, headers=headers, media_type=mimetype)
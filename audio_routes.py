@@ -0,0 +1,183 @@
+"""Library and audio file routes: the `audio` role.
+
+Serves stored tracks (with ranges and long-lived caching), their renditions
+and the paginated catalog, and keeps the library under its disk quota. Nothing
+here needs the emotion model or Spotify, so an audio-only process starts in
+well under a second.
+"""
+from datetime import datetime
+import os
+
+from flask import Blueprint, jsonify, request
+from werkzeug.security import safe_join
+
+from audio_serving import send_audio
+import audio_store
+import catalog
+import db
+import downloads
+import library
+import metrics
+import transcode
+
+bp = Blueprint('audio', __name__)
+
+# Default and maximum page sizes for GET /songs
+SONGS_PAGE_SIZE = 100
+SONGS_PAGE_MAX = 500
+# Cache lifetime for content-addressed /songs URLs, whose bytes never change
+IMMUTABLE_MAX_AGE_S = 31536000
+
+
+def start_background():
+    # Keep the catalog in step with the files on disk, off the request path
+    catalog.reconciler.start()
+    # Evict little-played tracks once songs/ outgrows LIBRARY_QUOTA_MB
+    library.library.start()
+
+
+@metrics.register_collector
+def _library_metrics():
+    status = library.library.status()
+    usage = (status['last_pass'] or {}).get('usage_bytes')
+    families = [
+        ('hwgide_library_evicted_files_total', 'counter', 'Stored files evicted to stay under the quota.',
+         [({}, status['evicted_files_total'])]),
+        ('hwgide_library_evicted_bytes_total', 'counter', 'Bytes freed by library eviction.',
+         [({}, status['evicted_bytes_total'])]),
+        ('hwgide_library_pending_plays', 'gauge', 'Played files whose plays are not written to the catalog yet.',
+         [({}, status['pending_plays'])]),
+    ]
+    if usage is not None:
+        families.append(('hwgide_library_usage_bytes', 'gauge', 'Bytes under songs/ at the last eviction pass.',
+                         [({}, usage)]))
+    return families
+
+
+@bp.route('/stats/library')
+def library_stats():
+    return jsonify(library.library.status())
+
+
+@bp.route('/songs/<path:filename>')
+def serve_song(filename):
+    songs_dir = audio_store.SONGS_DIR
+    full_path = safe_join(songs_dir, filename)
+    print(f"[serve_song] requested: {filename}; full_path={full_path}")
+    if full_path is None or not os.path.isfile(full_path):
+        print(f"[serve_song] file not found: {full_path}")
+        return jsonify({'error': 'file not found'}), 404
+    if request.headers.get('Range'):
+        print(f"[serve_song] Range header: {request.headers['Range']}")
+
+    download_name = os.path.basename(filename)
+    mimetype = transcode.mimetype_for(filename)
+    immutable = audio_store.is_content_key(filename) or audio_store.is_variant_key(filename)
+    if audio_store.is_content_key(filename):
+        # Content-addressed paths never change bytes; name the download after the track
+        with metrics.timed('db'):
+            row = db.get_song_by_path(filename)
+        if row is not None:
+            download_name = downloads.track_filename({'name': row['name'], 'artists': [{'name': row['artist']}]})
+    # Counts the play and keeps the file from eviction while it is being listened to
+    library.library.record_access(filename, request.headers.get('Range'))
+    try:
+        with metrics.timed('send'):
+            if immutable:
+                return send_audio(full_path, download_name, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE_S, immutable=True)
+            return send_audio(full_path, download_name, mimetype=mimetype)
+    except Exception as e:
+        print(f"[serve_song] error sending file: {e}")
+        return jsonify({'error': 'failed to send file', 'details': str(e)}), 500
+
+
+@bp.route('/renditions/<track_id>')
+def track_renditions(track_id):
+    """Lower-bitrate MP3 and HLS URLs for a saved track.
+
+    Answers 202 with Retry-After while the renditions are still being built
+    (and starts building them for tracks saved before transcoding existed).
+    """
+    row = db.get_song(track_id)
+    if row is None or not row['file_path']:
+        return jsonify({'error': 'track not found'}), 404
+    info = transcode.describe(row['file_path'], request.url_root)
+    if info is not None:
+        info['original_url'] = downloads.file_url_for(row['file_path'], request.url_root)
+        return jsonify(info)
+    if not transcode.schedule(row['file_path']):
+        return jsonify({'error': 'renditions are not available for this track'}), 404
+    rv = jsonify({'status': 'pending'})
+    rv.status_code = 202
+    rv.headers['Retry-After'] = '5'
+    return rv
+
+
+def parse_listing_args(args):
+    """(limit, db.list_songs keyword arguments, fields) from /songs query parameters.
+
+    Raises ValueError with the message to answer 400 with.
+    """
+    try:
+        limit = max(1, min(int(args.get('limit', SONGS_PAGE_SIZE)), SONGS_PAGE_MAX))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    after = None
+    if args.get('cursor'):
+        after = catalog.decode_cursor(args['cursor'])
+    since = None
+    if args.get('since'):
+        try:
+            since = float(args['since'])
+        except ValueError:
+            try:
+                since = datetime.fromisoformat(args['since']).timestamp()
+            except ValueError:
+                raise ValueError('since must be epoch seconds or an ISO date')
+    fields = [f for f in (args.get('fields') or '').split(',') if f]
+    unknown = [f for f in fields if f not in db.LISTING_COLUMNS and f != 'file_url']
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    fields = fields or list(db.LISTING_COLUMNS) + ['file_url']
+    filters = {
+        'after': after,
+        'artist': args.get('artist'),
+        'emotion': args.get('emotion'),
+        'search_query': args.get('search_query'),
+        'since': since,
+    }
+    return limit, filters, fields
+
+
+def listing_page(rows, limit, fields, url_root):
+    """JSON body of one /songs page."""
+    items = []
+    for row in rows:
+        item = {f: row[f] for f in fields if f != 'file_url'}
+        if 'file_url' in fields:
+            item['file_url'] = downloads.file_url_for(row['file_path'], url_root)
+        items.append(item)
+    return {
+        'files': [row['file_path'] for row in rows],
+        'items': items,
+        'count': len(items),
+        'next_cursor': catalog.encode_cursor(rows[-1]) if len(rows) == limit else None,
+    }
+
+
+@bp.route('/songs')
+def list_songs():
+    """Paginated catalog listing, newest first.
+
+    Query parameters: `limit`, `cursor` (from the previous page's `next_cursor`),
+    `fields` (comma-separated), and filters `artist`, `emotion`, `search_query`
+    and `since` (epoch seconds or ISO date). Responses carry an ETag.
+    """
+    try:
+        limit, filters, fields = parse_listing_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = db.list_songs(limit, **filters)
+    response = jsonify(listing_page(rows, limit, fields, request.url_root))
+    response.add_etag()
+    return response.make_conditional(request)
@@ -0,0 +1,164 @@
+"""Serving audio files with HTTP range and conditional request support.
+
+Single ranges and whole files go through `send_file(conditional=True)`, which
+streams from disk via `wsgi.file_wrapper` and answers If-None-Match,
+If-Modified-Since and If-Range itself. Multi-range requests, which werkzeug
+rejects, are answered here with a streamed multipart/byteranges body. Either
+way the file is never read into memory as a whole.
+"""
+import os
+import uuid
+
+from flask import Response, current_app, jsonify, request, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import http_date, parse_range_header
+from werkzeug.utils import send_file as send_file_for_environ
+
+# Size of each read when streaming multipart range bodies
+CHUNK_SIZE = 64 * 1024
+# More ranges than this in one request are ignored: the answer is the whole file, as a 200
+MAX_RANGES = 16
+
+
+def file_etag(st):
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def if_range_matches(if_range, has_header, etag, mtime):
+    """Whether a parsed If-Range header (`has_header` says one was sent) still holds."""
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(mtime) <= if_range.date.timestamp()
+    # no usable If-Range header at all
+    return not has_header
+
+
+def too_many_ranges(parsed):
+    """Whether a parsed Range header asks for more than MAX_RANGES ranges."""
+    return parsed is not None and parsed.units == 'bytes' and len(parsed.ranges) > MAX_RANGES
+
+
+def multi_range_spans(parsed, size):
+    """(start, stop) spans of a parsed Range header with several ranges, else None.
+
+    Returns [] when none of the ranges is satisfiable.
+    """
+    if parsed is None or parsed.units != 'bytes' or not (1 < len(parsed.ranges) <= MAX_RANGES):
+        return None
+    spans = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # suffix range: the last -start bytes
+            start, stop = max(0, size + start), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            spans.append((start, stop))
+    return spans
+
+
+def _multi_ranges(size, etag, mtime):
+    """Return the (start, stop) spans of a satisfiable multi-range request, else None."""
+    header = request.headers.get('Range')
+    if not header:
+        return None
+    spans = multi_range_spans(parse_range_header(header), size)
+    if spans is None or not if_range_matches(request.if_range, 'If-Range' in request.headers, etag, mtime):
+        return None
+    return spans
+
+
+def multipart_framing(spans, size, mimetype):
+    """(content_type, part_headers, closing, content_length) of a multipart/byteranges body."""
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode('ascii')
+        for start, stop in spans
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    length = sum(len(h) for h in part_headers) + sum(stop - start for start, stop in spans) + len(closing)
+    return f'multipart/byteranges; boundary={boundary}', part_headers, closing, length
+
+
+def _stream_parts(path, spans, part_headers, closing):
+    with open(path, 'rb') as fh:
+        for (start, stop), header in zip(spans, part_headers):
+            yield header
+            fh.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = fh.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        yield closing
+
+
+def _multipart_response(path, spans, size, mimetype, etag, mtime):
+    content_type, part_headers, closing, length = multipart_framing(spans, size, mimetype)
+    rv = Response(
+        _stream_parts(path, spans, part_headers, closing),
+        206,
+        content_type=content_type,
+        direct_passthrough=True,
+    )
+    rv.headers['Content-Length'] = str(length)
+    rv.headers['Accept-Ranges'] = 'bytes'
+    rv.set_etag(etag)
+    rv.headers['Last-Modified'] = http_date(mtime)
+    return rv
+
+
+def _send_whole_file(path, mimetype, etag, mtime, max_age):
+    # Flask's send_file reads request.environ; leave out the Range so werkzeug doesn't refuse it
+    environ = {k: v for k, v in request.environ.items() if k not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+    return send_file_for_environ(
+        path, environ, mimetype=mimetype, conditional=True, etag=etag, last_modified=mtime,
+        max_age=max_age, use_x_sendfile=current_app.config['USE_X_SENDFILE'],
+        response_class=current_app.response_class,
+    )
+
+
+def send_audio(path, download_name, mimetype='audio/mpeg', max_age=None, immutable=False):
+    """Build the response for an audio file, honouring Range and conditional headers.
+
+    `immutable` marks the response cacheable forever (for content-addressed paths).
+    """
+    st = os.stat(path)
+    etag = file_etag(st)
+
+    if request.headers.get('Range') and request.if_none_match.contains(etag):
+        rv = Response(status=304)
+        rv.set_etag(etag)
+    else:
+        spans = _multi_ranges(st.st_size, etag, st.st_mtime)
+        if spans == []:
+            rv = jsonify({'error': 'Range not satisfiable'})
+            rv.status_code = 416
+            rv.headers['Content-Range'] = f'bytes */{st.st_size}'
+            return rv
+        if spans:
+            rv = _multipart_response(path, spans, st.st_size, mimetype, etag, st.st_mtime)
+        elif too_many_ranges(parse_range_header(request.headers.get('Range'))):
+            rv = _send_whole_file(path, mimetype, etag, st.st_mtime, max_age)
+        else:
+            try:
+                rv = send_file(path, mimetype=mimetype, conditional=True, etag=etag,
+                               last_modified=st.st_mtime, max_age=max_age)
+            except RequestedRangeNotSatisfiable:
+                rv = jsonify({'error': 'Range start out of bounds'})
+                rv.status_code = 416
+                rv.headers['Content-Range'] = f'bytes */{st.st_size}'
+                return rv
+    if max_age:
+        rv.cache_control.public = True
+        rv.cache_control.max_age = max_age
+        rv.cache_control.no_cache = None
+    if immutable:
+        rv.cache_control.immutable = True
+    rv.headers['Access-Control-Allow-Origin'] = '*'
+    rv.headers['Content-Disposition'] = f'inline; filename="{download_name}"'
+    return rv
@@ -0,0 +1,168 @@
+"""Content-addressed storage for downloaded audio.
+
+Files are stored under `songs/` by the SHA-256 of their bytes, sharded into two
+levels of subdirectories (`songs/ab/cd/abcd....mp3`). A stored path therefore
+always refers to the same bytes, so `/songs/<path>` URLs can be cached
+forever; the human-readable name lives in `saved_songs`.
+
+Placing a file and recording it, or forgetting a file and removing it, happen
+under `store_lock` for that path, so the library manager never deletes bytes a
+download has just been deduplicated against.
+"""
+import hashlib
+import os
+import re
+import shutil
+
+from filelock import FileLock
+
+SONGS_DIR = os.path.abspath('songs')
+# Lock files shared by every process using the store (downloads, pool keeper, library)
+LOCKS_DIR = os.path.join(SONGS_DIR, '.locks')
+
+_KEY_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$')
+_VARIANT_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}/[A-Za-z0-9_./-]+$')
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+_HASH_CHUNK = 1024 * 1024
+# Leading bytes kept in the catalog so responses can show them without opening the file
+HEAD_BYTES = 128
+
+
+def hash_file(path):
+    """(SHA-256 hex digest, first HEAD_BYTES bytes) of a file, read in one pass."""
+    digest = hashlib.sha256()
+    head = None
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_HASH_CHUNK), b''):
+            if head is None:
+                head = chunk[:HEAD_BYTES]
+            digest.update(chunk)
+    return digest.hexdigest(), head or b''
+
+
+def read_head(path):
+    with open(path, 'rb') as fh:
+        return fh.read(HEAD_BYTES)
+
+
+def key_for(content_hash, ext='mp3'):
+    """Relative store path (always with forward slashes) for a content hash."""
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.{ext}"
+
+
+def is_content_key(rel_path):
+    """True for paths produced by `key_for`, whose bytes can never change."""
+    return bool(_KEY_RE.match(rel_path or ''))
+
+
+def variants_key(rel_path):
+    """Directory next to a content-addressed file that holds files derived from it."""
+    return rel_path.rsplit('.', 1)[0]
+
+
+def is_variant_key(rel_path):
+    """True for files inside a `variants_key` directory; like the original they never change."""
+    return bool(_VARIANT_RE.match(rel_path or '')) and '..' not in rel_path
+
+
+def is_variants_dir(name):
+    return bool(_HASH_RE.match(name))
+
+
+def abs_path(rel_path):
+    return os.path.join(SONGS_DIR, *rel_path.split('/'))
+
+
+def _safe_name(rel_path):
+    return "".join(ch if ch.isalnum() else "_" for ch in rel_path)
+
+
+def store_lock(rel_path):
+    """Cross-process lock on one stored path; hold it while placing or removing the file."""
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    return FileLock(os.path.join(LOCKS_DIR, f"store-{_safe_name(rel_path)}.lock"))
+
+
+def _in_use_marker(rel_path):
+    return os.path.join(LOCKS_DIR, f"inuse-{_safe_name(rel_path)}")
+
+
+def mark_in_use(rel_path):
+    """Note that `rel_path` is being served right now, for every process sharing the store."""
+    marker = _in_use_marker(rel_path)
+    try:
+        os.utime(marker)
+    except FileNotFoundError:
+        os.makedirs(LOCKS_DIR, exist_ok=True)
+        open(marker, 'a').close()
+
+
+def in_use_since(rel_path):
+    """When `rel_path` was last marked in use (epoch seconds), or None if never."""
+    try:
+        return os.path.getmtime(_in_use_marker(rel_path))
+    except OSError:
+        return None
+
+
+def place(src_path, rel_path):
+    """Move `src_path` into the store at `rel_path` (from `key_for` its hash).
+
+    If identical bytes are already stored, the existing copy is kept and
+    `src_path` is removed.
+    """
+    dest = abs_path(rel_path)
+    if os.path.exists(dest):
+        os.remove(src_path)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # Land next to the destination first so the final rename is atomic
+    part_path = f"{dest}.{os.getpid()}.part"
+    shutil.move(src_path, part_path)
+    os.replace(part_path, dest)
+
+
+def _tree_size(path):
+    total = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def disk_usage():
+    """Bytes of every file under `songs/`, renditions and partial files included."""
+    total = 0
+    if not os.path.isdir(SONGS_DIR):
+        return total
+    for entry in os.scandir(SONGS_DIR):
+        if entry.name == os.path.basename(LOCKS_DIR):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            total += _tree_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            total += entry.stat().st_size
+    return total
+
+
+def remove(rel_path):
+    """Delete a stored file and the renditions derived from it; returns the bytes freed."""
+    freed = 0
+    path = abs_path(rel_path)
+    try:
+        freed += os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    if is_content_key(rel_path):
+        variants = abs_path(variants_key(rel_path))
+        freed += _tree_size(variants)
+        shutil.rmtree(variants, ignore_errors=True)
+    try:
+        os.remove(_in_use_marker(rel_path))
+    except FileNotFoundError:
+        pass
+    return freed
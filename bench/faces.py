@@ -0,0 +1,53 @@
+"""Synthetic face photos for benchmarking the photo endpoint.
+
+Draws simple cartoon faces (skin-toned ellipse, eyes, brows and a mouth whose
+curve varies) with OpenCV at a range of sizes and positions, JPEG-encoded like
+webcam captures. They only need to be realistic enough to exercise decoding,
+detection and the emotion model, not to be classified correctly.
+"""
+import random
+
+import cv2
+import numpy as np
+
+SIZES = ((640, 480), (1280, 720), (1920, 1080))
+
+
+def make_face(rng, width, height):
+    img = np.full((height, width, 3), rng.randint(40, 200), dtype=np.uint8)
+    noise = np.random.default_rng(rng.randint(0, 2 ** 32 - 1)).integers(0, 25, img.shape, dtype=np.uint8)
+    img = cv2.add(img, noise)
+    face_h = int(height * rng.uniform(0.35, 0.6))
+    face_w = int(face_h * 0.75)
+    cx = rng.randint(face_w, width - face_w)
+    cy = rng.randint(face_h // 2 + 10, height - face_h // 2 - 10)
+    skin = (rng.randint(60, 140), rng.randint(110, 180), rng.randint(170, 240))
+    cv2.ellipse(img, (cx, cy), (face_w // 2, face_h // 2), 0, 0, 360, skin, -1)
+    eye_dx, eye_y = face_w // 5, cy - face_h // 8
+    for ex in (cx - eye_dx, cx + eye_dx):
+        cv2.ellipse(img, (ex, eye_y), (face_w // 12, face_h // 24), 0, 0, 360, (255, 255, 255), -1)
+        cv2.circle(img, (ex, eye_y), max(2, face_h // 40), (30, 20, 10), -1)
+        tilt = rng.randint(-8, 8)
+        cv2.line(img, (ex - face_w // 10, eye_y - face_h // 12 + tilt),
+                 (ex + face_w // 10, eye_y - face_h // 12 - tilt), (40, 30, 20), max(2, face_h // 60))
+    # mouth: smile, frown or flat
+    mouth_y = cy + face_h // 4
+    start, end = rng.choice(((0, 180), (180, 360), (0, 0)))
+    if start == end:
+        cv2.line(img, (cx - face_w // 6, mouth_y), (cx + face_w // 6, mouth_y), (40, 40, 150), max(2, face_h // 50))
+    else:
+        cv2.ellipse(img, (cx, mouth_y), (face_w // 6, face_h // 16), 0, start, end, (40, 40, 150), max(2, face_h // 50))
+    return img
+
+
+def make_faces(count=16, seed=0, quality=85):
+    """`count` JPEG-encoded face photos as bytes."""
+    rng = random.Random(seed)
+    photos = []
+    for i in range(count):
+        width, height = SIZES[i % len(SIZES)]
+        ok, buf = cv2.imencode('.jpg', make_face(rng, width, height), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise RuntimeError('failed to encode synthetic face')
+        photos.append(buf.tobytes())
+    return photos
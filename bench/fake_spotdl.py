@@ -0,0 +1,59 @@
+"""Fake `spotdl` for benchmarks: writes a valid MP3 instead of downloading one.
+
+Accepts the arguments the service passes (`--output <dir> <url>`). It appends
+MPEG-1 Layer III frames to `<dir>/<name>.mp3` over FAKE_SPOTDL_DELAY_S
+seconds, as spotdl's ffmpeg step does, so progressive streaming sees a growing
+file. The audio bytes are derived from the URL, so every track has distinct
+content. Use with `SPOTDL_BIN="python bench/fake_spotdl.py"`.
+
+FAKE_SPOTDL_DELAY_S    time taken to "download" (default 1.0)
+FAKE_SPOTDL_SECONDS    length of the generated track in seconds (default 30)
+FAKE_SPOTDL_FAIL_RATE  fraction of runs that exit non-zero (default 0)
+"""
+import hashlib
+import os
+import random
+import sys
+import time
+
+# 128 kbps, 44.1 kHz, joint stereo, no padding: 417-byte frames of 1152 samples
+FRAME_HEADER = b'\xff\xfb\x90\x64'
+FRAME_SIZE = 417
+FRAME_SECONDS = 1152 / 44100
+
+
+def mp3_frames(seed, seconds):
+    rng = random.Random(seed)
+    count = max(1, int(seconds / FRAME_SECONDS))
+    return [FRAME_HEADER + rng.randbytes(FRAME_SIZE - len(FRAME_HEADER)) for _ in range(count)]
+
+
+def main(argv):
+    if '--output' not in argv or argv.index('--output') + 2 > len(argv):
+        print('usage: fake_spotdl.py --output <dir> <url>', file=sys.stderr)
+        return 2
+    out_dir = argv[argv.index('--output') + 1]
+    url = argv[-1]
+    delay = float(os.getenv('FAKE_SPOTDL_DELAY_S', '1.0'))
+    seconds = float(os.getenv('FAKE_SPOTDL_SECONDS', '30'))
+    fail_rate = float(os.getenv('FAKE_SPOTDL_FAIL_RATE', '0'))
+
+    seed = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    frames = mp3_frames(seed, seconds)
+    path = os.path.join(out_dir, f'Bench Artist - {seed[:12]}.mp3')
+    steps = 20
+    per_step = max(1, len(frames) // steps)
+    with open(path, 'wb') as fh:
+        for i in range(0, len(frames), per_step):
+            fh.write(b''.join(frames[i:i + per_step]))
+            fh.flush()
+            time.sleep(delay / steps)
+    if random.random() < fail_rate:
+        print(f'fake spotdl: simulated failure for {url}', file=sys.stderr)
+        return 1
+    print(f'Downloaded "{os.path.basename(path)}": {url}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,143 @@
+"""Stand-in for the parts of the Spotify Web API the service calls.
+
+Answers the client-credentials token request, playlist and track search, and
+paginated playlist items with deterministic, generated data, so benchmarks run
+without network access. Point the service at it with
+
+    SPOTIFY_API_PREFIX=http://127.0.0.1:<port>/v1/
+    SPOTIFY_TOKEN_URL=http://127.0.0.1:<port>/api/token
+
+Run standalone with `python bench/fake_spotify.py --port 8901`.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def spotify_id(*parts):
+    """22-character base62 id derived from `parts`, stable across runs."""
+    n = int.from_bytes(hashlib.sha256('/'.join(map(str, parts)).encode()).digest()[:17], 'big')
+    chars = []
+    for _ in range(22):
+        n, r = divmod(n, 62)
+        chars.append(_BASE62[r])
+    return ''.join(chars)
+
+
+def make_track(seed):
+    rng = random.Random(seed)
+    track_id = spotify_id('track', seed)
+    return {
+        'id': track_id,
+        'name': f'Bench Song {seed}',
+        'popularity': rng.randint(30, 100),
+        'is_local': False,
+        'artists': [{'name': f'Bench Artist {rng.randint(1, 50)}'}],
+        'album': {
+            'name': f'Bench Album {rng.randint(1, 200)}',
+            'release_date': f'{rng.randint(1970, 2025)}-01-01',
+            'images': [{'url': f'https://example.invalid/cover/{track_id}.jpg', 'width': 640, 'height': 640}],
+        },
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+    }
+
+
+class FakeSpotify:
+    def __init__(self, playlists_per_query=5, tracks_per_playlist=250, latency_ms=0):
+        self.playlists_per_query = playlists_per_query
+        self.tracks_per_playlist = tracks_per_playlist
+        self.latency_s = latency_ms / 1000.0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def playlists_for(self, query):
+        items = [{'id': spotify_id('playlist', query, i), 'name': f'{query} mix {i}'}
+                 for i in range(self.playlists_per_query)]
+        # Spotify really does return null entries in playlist searches
+        return items[:2] + [None] + items[2:]
+
+    def playlist_page(self, playlist_id, offset, limit):
+        stop = min(self.tracks_per_playlist, offset + limit)
+        return {
+            'total': self.tracks_per_playlist,
+            'items': [{'track': make_track(f'{playlist_id}:{i}')} for i in range(offset, stop)],
+        }
+
+    def handle(self, method, path, query):
+        with self._lock:
+            self.requests += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        if method == 'POST' and path == '/api/token':
+            return 200, {'access_token': 'bench-token', 'token_type': 'Bearer', 'expires_in': 3600}
+        if method == 'GET' and path == '/v1/search':
+            q = query.get('q', [''])[0]
+            limit = int(query.get('limit', ['10'])[0])
+            if query.get('type', ['track'])[0] == 'playlist':
+                return 200, {'playlists': {'items': self.playlists_for(q)[:limit]}}
+            return 200, {'tracks': {'items': [make_track(f'search:{q}:{i}') for i in range(limit)]}}
+        parts = path.strip('/').split('/')
+        if method == 'GET' and len(parts) == 4 and parts[:2] == ['v1', 'playlists'] and parts[3] == 'tracks':
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query.get('limit', ['100'])[0])
+            return 200, self.playlist_page(parts[2], offset, limit)
+        return 404, {'error': {'status': 404, 'message': f'no fake for {method} {path}'}}
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _answer(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            url = urlparse(self.path)
+            status, body = fake.handle(method, url.path, parse_qs(url.query))
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._answer('GET')
+
+        def do_POST(self):
+            self._answer('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start(port=0, **options):
+    """Serve a FakeSpotify on a background thread. Returns (server, fake, base_url)."""
+    fake = FakeSpotify(**options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-spotify', daemon=True).start()
+    return server, fake, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--tracks-per-playlist', type=int, default=250)
+    args = parser.parse_args()
+    server, _, base_url = start(args.port, latency_ms=args.latency_ms, tracks_per_playlist=args.tracks_per_playlist)
+    print(f'fake Spotify API on {base_url}/v1/ (token: {base_url}/api/token)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,316 @@
+"""Offline end-to-end benchmark for the service.
+
+Starts the fake Spotify API and the service (with the fake spotdl) in a
+scratch directory. It then drives each scenario at a fixed concurrency and
+prints one JSON document with p50/p95/p99 latency, requests per second, error
+counts and the server's peak RSS per scenario. A 202 only hands over a
+download job, so it is counted as `accepted` and left out of the latencies.
+Save the output from two branches and compare them.
+
+    python bench/run.py --scenarios photo,request_song,range --concurrency 8 --requests 200
+
+`--server asgi` runs the ASGI app (asgi.py) under uvicorn instead of the
+Flask app under the Werkzeug server.
+
+Scenarios:
+  photo         POST / with synthetic face photos (needs the emotion model)
+  request_song  POST /request_song for a rotating set of titles
+  range         GET /songs/<file> with random 64 KiB Range requests
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_spotify  # noqa: E402
+
+SCENARIOS = ('photo', 'request_song', 'range')
+RANGE_BYTES = 64 * 1024
+_BOOTS = {
+    'flask': ("import sys, spotifyAccessTest as m; "
+              "m.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True, debug=False)"),
+    'asgi': ("import sys, uvicorn; "
+             "uvicorn.run('asgi:app', host='127.0.0.1', port=int(sys.argv[1]), log_level='warning')"),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def rss_bytes(pid):
+    """Resident set size of `pid` from /proc (Linux only); None elsewhere."""
+    try:
+        with open(f'/proc/{pid}/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = rss_bytes(self.pid)
+            if value is not None and (self.peak is None or value > self.peak):
+                self.peak = value
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Server:
+    """The service in a subprocess with its own songs/ and songs.db."""
+
+    def __init__(self, spotify_url, workdir, args):
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        env = dict(os.environ)
+        env.update({
+            'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')])),
+            'CLIENT_ID': 'bench',
+            'CLIENT_SECRET': 'bench',
+            'SPOTIFY_API_PREFIX': f'{spotify_url}/v1/',
+            'SPOTIFY_TOKEN_URL': f'{spotify_url}/api/token',
+            'SPOTDL_BIN': f'"{sys.executable}" "{os.path.join(BENCH_DIR, "fake_spotdl.py")}"',
+            'FAKE_SPOTDL_DELAY_S': str(args.spotdl_delay),
+            'FAKE_SPOTDL_SECONDS': str(args.track_seconds),
+            'EMOTION_POOL': '1' if args.pool else '0',
+            'TRANSCODE_ENABLED': '0',
+        })
+        for item in args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+        self.log = open(os.path.join(workdir, 'server.log'), 'wb')
+        self.proc = subprocess.Popen([sys.executable, '-c', _BOOTS[args.server], str(self.port)], cwd=workdir, env=env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, need_model, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'server exited with {self.proc.returncode}; see {self.log.name}')
+            try:
+                r = requests.get(f'{self.base_url}/ready', timeout=2)
+                if r.status_code == 200 or not need_model:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f'server not ready after {timeout}s; see {self.log.name}')
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+def run_scenario(make_request, total, concurrency, warmup, pid):
+    sessions = threading.local()
+
+    def one(i):
+        session = getattr(sessions, 'session', None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            status = make_request(session, i)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(warmup)))
+        with RssSampler(pid) as rss:
+            started = time.perf_counter()
+            results = list(pool.map(one, range(total)))
+            elapsed = time.perf_counter() - started
+
+    # Latency of answers that delivered the song (or range); a 202 job handoff would flatter it
+    latencies = sorted(lat for lat, status in results if str(status).startswith('2') and str(status) != '202')
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+    accepted = statuses.get('202', 0)
+    ms = lambda v: None if v is None else round(v * 1000, 2)  # noqa: E731
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': errors,
+        'accepted': accepted,
+        'statuses': statuses,
+        'duration_s': round(elapsed, 3),
+        'rps': round(total / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'peak_rss_mb': None if rss.peak is None else round(rss.peak / 2 ** 20, 1),
+    }
+
+
+def photo_request(base_url, photos):
+    def make(session, i):
+        files = {'photo': (f'face{i}.jpg', photos[i % len(photos)], 'image/jpeg')}
+        return session.post(f'{base_url}/', files=files, timeout=300).status_code
+    return make
+
+
+def request_song_request(base_url, distinct):
+    def make(session, i):
+        body = {'title': f'bench title {i % distinct}', 'artist': 'bench'}
+        return session.post(f'{base_url}/request_song', json=body, timeout=300).status_code
+    return make
+
+
+def range_request(base_url, files):
+    def make(session, i):
+        url, size = files[i % len(files)]
+        start = random.randrange(0, max(1, size - RANGE_BYTES))
+        headers = {'Range': f'bytes={start}-{start + RANGE_BYTES - 1}'}
+        r = session.get(url, headers=headers, timeout=60)
+        len(r.content)
+        return r.status_code
+    return make
+
+
+def catalog_files(base_url):
+    r = requests.get(f'{base_url}/songs', params={'limit': 100, 'fields': 'file_url,file_size'}, timeout=30)
+    r.raise_for_status()
+    return [(item['file_url'], item['file_size'] or RANGE_BYTES) for item in r.json()['items'] if item.get('file_url')]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark (see module docstring).')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests before each scenario')
+    parser.add_argument('--distinct-songs', type=int, default=20, help='titles rotated through by request_song')
+    parser.add_argument('--faces', type=int, default=16)
+    parser.add_argument('--spotdl-delay', type=float, default=1.0, help='seconds the fake spotdl takes per track')
+    parser.add_argument('--track-seconds', type=float, default=30)
+    parser.add_argument('--spotify-latency-ms', type=float, default=20)
+    parser.add_argument('--server', choices=sorted(_BOOTS), default='flask')
+    parser.add_argument('--pool', action='store_true', help='run with the emotion pool keeper enabled')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the server (repeatable)')
+    parser.add_argument('--ready-timeout', type=float, default=300)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix='hwgide-bench-')
+    spotify_server, fake, spotify_url = fake_spotify.start(latency_ms=args.spotify_latency_ms)
+    server = Server(spotify_url, workdir, args)
+    report = {
+        'git_revision': git_revision(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'keep')},
+        'scenarios': {},
+    }
+    try:
+        server.wait_ready('photo' in scenarios, args.ready_timeout)
+        for name in scenarios:
+            if name == 'photo':
+                from faces import make_faces
+                make = photo_request(server.base_url, make_faces(args.faces))
+            elif name == 'request_song':
+                make = request_song_request(server.base_url, args.distinct_songs)
+            else:
+                files = catalog_files(server.base_url)
+                if not files:
+                    # populate the library first
+                    seed = request_song_request(server.base_url, args.distinct_songs)
+                    with requests.Session() as session:
+                        for i in range(min(5, args.distinct_songs)):
+                            seed(session, i)
+                    files = catalog_files(server.base_url)
+                if not files:
+                    report['scenarios'][name] = {'error': 'no songs available to request ranges from'}
+                    continue
+                make = range_request(server.base_url, files)
+            print(f'[bench] {name}: {args.requests} requests at concurrency {args.concurrency}', file=sys.stderr)
+            report['scenarios'][name] = run_scenario(
+                make, args.requests, args.concurrency, args.warmup, server.proc.pid)
+        report['fake_spotify_requests'] = fake.requests
+    finally:
+        server.stop()
+        spotify_server.shutdown()
+        if args.keep:
+            print(f'[bench] scratch directory kept at {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Keeps the `saved_songs` catalog in step with the files under `songs/`.
+
+`/songs` lists the catalog instead of scanning the directory, so a background
+reconciler periodically walks the store: rows whose file disappeared are
+dropped (the track is downloaded again next time it is picked), rows from
+before file paths were recorded get their legacy file name filled in, and rows
+from before audio metadata was captured at ingest get it read from the file.
+"""
+import base64
+import json
+import os
+import threading
+import time
+
+import audio_store
+import db
+import downloads
+
+CATALOG_RECONCILE_INTERVAL_S = float(os.getenv('CATALOG_RECONCILE_INTERVAL_S', '3600'))
+
+
+def encode_cursor(row):
+    raw = json.dumps([row['created_at'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; raises ValueError for anything malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, track_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(created_at), str(track_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def reconcile():
+    """One pass over the catalog. Returns counts of what changed."""
+    stats = {'checked': 0, 'adopted_legacy': 0, 'removed_missing': 0, 'orphan_files': 0,
+             'backfilled_metadata': 0}
+    known = set()
+    for row in db.all_file_rows():
+        stats['checked'] += 1
+        file_path = row['file_path']
+        if file_path is None:
+            legacy = downloads.track_filename({'name': row['name'], 'artists': [{'name': row['artist']}]})
+            if os.path.isfile(audio_store.abs_path(legacy)):
+                db.set_file_path(row['id'], legacy)
+                stats['adopted_legacy'] += 1
+                known.add(legacy)
+                if downloads.backfill_metadata(row['id'], legacy):
+                    stats['backfilled_metadata'] += 1
+                continue
+            file_path = legacy
+        elif os.path.isfile(audio_store.abs_path(file_path)):
+            known.add(file_path)
+            if row['missing_metadata'] and downloads.backfill_metadata(row['id'], file_path):
+                stats['backfilled_metadata'] += 1
+            continue
+        db.delete_song(row['id'])
+        stats['removed_missing'] += 1
+
+    for root, dirs, names in os.walk(audio_store.SONGS_DIR):
+        # renditions and in-progress transcodes are derived files, not catalog entries
+        dirs[:] = [d for d in dirs
+                   if not d.startswith('.') and not d.endswith('.part') and not audio_store.is_variants_dir(d)]
+        rel_root = os.path.relpath(root, audio_store.SONGS_DIR)
+        for name in names:
+            if name.endswith('.part'):
+                continue
+            rel = name if rel_root == '.' else f"{rel_root.replace(os.sep, '/')}/{name}"
+            if rel not in known:
+                stats['orphan_files'] += 1
+    return stats
+
+
+class Reconciler:
+    def __init__(self, interval=CATALOG_RECONCILE_INTERVAL_S):
+        self.interval = interval
+        self.last_stats = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='catalog-reconcile', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.last_stats = reconcile()
+                print(f"[catalog] reconciled: {self.last_stats}")
+            except Exception as e:
+                print(f"[catalog] reconcile failed: {e}")
+            time.sleep(self.interval)
+
+
+reconciler = Reconciler()
@@ -0,0 +1,372 @@
+"""SQLite access for the `saved_songs` catalog.
+
+Each thread reuses one connection (opened in WAL mode with synchronous=NORMAL
+so readers never wait behind the downloader's writes). The schema is versioned
+with `PRAGMA user_version` and brought up to date once by `migrate()` at
+startup instead of on every request. All SQL lives in module constants so
+sqlite3's per-connection statement cache can reuse the prepared statements.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+DB_PATH = os.getenv('SONGS_DB', 'songs.db')
+DB_BUSY_TIMEOUT_S = float(os.getenv('SONGS_DB_BUSY_TIMEOUT_S', '10'))
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = False
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_S, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+def connection():
+    """The calling thread's connection, opened on first use (and again after a fork)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'pid', None) != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def close():
+    """Close the calling thread's connection, if any."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'pid', None) == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+# --- migrations -------------------------------------------------------------
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _add_columns(conn, table, columns):
+    existing = _columns(conn, table)
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+
+def _m001_base(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS saved_songs (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            artist TEXT,
+            search_query TEXT
+        )
+    ''')
+
+
+def _m002_emotion_pool(conn):
+    # These columns were first added ad hoc by the downloader, so they may exist already
+    _add_columns(conn, 'saved_songs', (
+        ('emotion', 'TEXT'),
+        ('pooled', 'INTEGER NOT NULL DEFAULT 0'),
+        ('track_json', 'TEXT'),
+    ))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_emotion_pooled ON saved_songs (emotion, pooled)')
+
+
+def _m003_file_metadata(conn):
+    _add_columns(conn, 'saved_songs', (
+        ('created_at', 'REAL'),
+        ('file_path', 'TEXT'),
+        ('file_size', 'INTEGER'),
+        ('duration', 'REAL'),
+    ))
+    conn.execute('UPDATE saved_songs SET created_at = ? WHERE created_at IS NULL', (time.time(),))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_search_query ON saved_songs (search_query)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_created_at ON saved_songs (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_file_path ON saved_songs (file_path)')
+
+
+def _m004_content_hash(conn):
+    _add_columns(conn, 'saved_songs', (('content_hash', 'TEXT'),))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_content_hash ON saved_songs (content_hash)')
+
+
+def _m005_listing_index(conn):
+    # Keyset pagination for /songs walks (created_at, id) newest first
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_created_id ON saved_songs (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_songs_emotion_created ON saved_songs (emotion, created_at)')
+
+
+def _m006_audio_metadata(conn):
+    # Filled in at ingest so responses are built from the row; the reconciler backfills older rows
+    _add_columns(conn, 'saved_songs', (
+        ('bitrate', 'INTEGER'),
+        ('mime', 'TEXT'),
+        ('file_head', 'BLOB'),
+        ('renditions', 'TEXT'),
+    ))
+
+
+def _m007_library_usage(conn):
+    _add_columns(conn, 'saved_songs', (
+        ('play_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_played_at', 'REAL'),
+    ))
+
+
+# Append only: position + 1 is the schema version the migration produces
+MIGRATIONS = (
+    _m001_base,
+    _m002_emotion_pool,
+    _m003_file_metadata,
+    _m004_content_hash,
+    _m005_listing_index,
+    _m006_audio_metadata,
+    _m007_library_usage,
+)
+
+
+def migrate():
+    """Bring the schema up to `len(MIGRATIONS)`. Cheap no-op after the first call."""
+    global _migrated
+    if _migrated:
+        return
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = _connect()
+        try:
+            # IMMEDIATE takes the write lock so concurrent processes migrate one at a time
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+                    step(conn)
+                    conn.execute(f'PRAGMA user_version = {number}')
+                    print(f"[db] applied migration {number}: {step.__name__}")
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        _migrated = True
+
+
+# --- saved_songs ------------------------------------------------------------
+
+_SQL_IS_SAVED = 'SELECT 1 FROM saved_songs WHERE id = ?'
+_SQL_GET_SONG = 'SELECT * FROM saved_songs WHERE id = ?'
+_SQL_UPSERT_SONG = '''
+    INSERT INTO saved_songs (id, name, artist, search_query, emotion, track_json,
+                             created_at, file_path, file_size, duration, content_hash,
+                             bitrate, mime, file_head)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        name = excluded.name,
+        artist = excluded.artist,
+        search_query = excluded.search_query,
+        emotion = COALESCE(excluded.emotion, saved_songs.emotion),
+        track_json = excluded.track_json,
+        file_path = excluded.file_path,
+        file_size = excluded.file_size,
+        duration = excluded.duration,
+        content_hash = excluded.content_hash,
+        bitrate = excluded.bitrate,
+        mime = excluded.mime,
+        file_head = excluded.file_head,
+        renditions = CASE WHEN saved_songs.file_path = excluded.file_path
+                          THEN saved_songs.renditions END
+'''
+_SQL_GET_SONG_BY_PATH = 'SELECT * FROM saved_songs WHERE file_path = ? LIMIT 1'
+_SQL_POOL_COUNT = 'SELECT COUNT(*) FROM saved_songs WHERE emotion = ? AND pooled = 1'
+_SQL_ADD_TO_POOL = '''
+    UPDATE saved_songs SET emotion = ?, pooled = 1, track_json = COALESCE(track_json, ?)
+    WHERE id = ? AND (pooled = 0 OR emotion = ?)
+'''
+_SQL_POOL_CANDIDATES = '''
+    SELECT id, track_json, file_path, file_size, mime, file_head, renditions FROM saved_songs
+    WHERE emotion = ? AND pooled = 1 ORDER BY RANDOM() LIMIT ?
+'''
+_SQL_UNPOOL = 'UPDATE saved_songs SET pooled = 0 WHERE id = ? AND pooled = 1'
+
+
+def is_saved(track_id):
+    return connection().execute(_SQL_IS_SAVED, (track_id,)).fetchone() is not None
+
+
+def get_song(track_id):
+    return connection().execute(_SQL_GET_SONG, (track_id,)).fetchone()
+
+
+def get_song_by_path(file_path):
+    return connection().execute(_SQL_GET_SONG_BY_PATH, (file_path,)).fetchone()
+
+
+def upsert_song(track_id, name, artist, search_query, emotion=None, track_json=None,
+                file_path=None, file_size=None, duration=None, content_hash=None,
+                bitrate=None, mime=None, file_head=None):
+    conn = connection()
+    with conn:
+        conn.execute(_SQL_UPSERT_SONG, (
+            track_id, name, artist, search_query, emotion, track_json,
+            time.time(), file_path, file_size, duration, content_hash,
+            bitrate, mime, file_head,
+        ))
+
+
+def pool_count(emotion):
+    return connection().execute(_SQL_POOL_COUNT, (emotion,)).fetchone()[0]
+
+
+def add_to_pool(track_id, emotion, track_json):
+    conn = connection()
+    with conn:
+        cur = conn.execute(_SQL_ADD_TO_POOL, (emotion, track_json, track_id, emotion))
+    return cur.rowcount == 1
+
+
+def pool_candidates(emotion, limit=8):
+    return connection().execute(_SQL_POOL_CANDIDATES, (emotion, limit)).fetchall()
+
+
+def unpool(track_id):
+    """Take a track out of its pool. Returns True only for the caller that did it."""
+    conn = connection()
+    with conn:
+        cur = conn.execute(_SQL_UNPOOL, (track_id,))
+    return cur.rowcount == 1
+
+
+# Columns /songs may return; anything else in `fields` is ignored
+LISTING_COLUMNS = ('id', 'name', 'artist', 'search_query', 'emotion', 'created_at',
+                   'file_path', 'file_size', 'duration')
+
+
+def list_songs(limit, after=None, artist=None, emotion=None, search_query=None, since=None):
+    """One page of catalog rows, newest first.
+
+    `after` is the (created_at, id) of the last row of the previous page.
+    Rows without a stored file are skipped.
+    """
+    clauses = ['file_path IS NOT NULL']
+    params = []
+    if after is not None:
+        clauses.append('(created_at < ? OR (created_at = ? AND id < ?))')
+        params.extend([after[0], after[0], after[1]])
+    if artist:
+        clauses.append("artist LIKE ? ESCAPE '\\'")
+        escaped = artist.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f'%{escaped}%')
+    if emotion:
+        clauses.append('emotion = ?')
+        params.append(emotion)
+    if search_query:
+        clauses.append('search_query = ?')
+        params.append(search_query)
+    if since is not None:
+        clauses.append('created_at >= ?')
+        params.append(since)
+    sql = (f"SELECT {', '.join(LISTING_COLUMNS)} FROM saved_songs WHERE {' AND '.join(clauses)} "
+           "ORDER BY created_at DESC, id DESC LIMIT ?")
+    params.append(limit)
+    return connection().execute(sql, params).fetchall()
+
+
+_SQL_ALL_FILES = 'SELECT id, name, artist, file_path, file_head IS NULL AS missing_metadata FROM saved_songs'
+_SQL_SET_FILE_PATH = 'UPDATE saved_songs SET file_path = ? WHERE id = ?'
+_SQL_SET_AUDIO_METADATA = '''
+    UPDATE saved_songs SET file_size = ?, bitrate = COALESCE(?, bitrate), mime = ?, file_head = ?,
+                           renditions = ?
+    WHERE id = ?
+'''
+_SQL_SET_RENDITIONS = 'UPDATE saved_songs SET renditions = ? WHERE file_path = ?'
+_SQL_DELETE_SONG = 'DELETE FROM saved_songs WHERE id = ?'
+
+
+def all_file_rows():
+    return connection().execute(_SQL_ALL_FILES).fetchall()
+
+
+def set_file_path(track_id, file_path):
+    conn = connection()
+    with conn:
+        conn.execute(_SQL_SET_FILE_PATH, (file_path, track_id))
+
+
+def set_audio_metadata(track_id, file_size, mime, file_head, bitrate=None, renditions=None):
+    conn = connection()
+    with conn:
+        conn.execute(_SQL_SET_AUDIO_METADATA, (file_size, bitrate, mime, file_head, renditions, track_id))
+
+
+def set_renditions(file_path, renditions):
+    """Record the rendition bitrates built for `file_path` on every row that stores it."""
+    conn = connection()
+    with conn:
+        conn.execute(_SQL_SET_RENDITIONS, (renditions, file_path))
+
+
+def delete_song(track_id):
+    conn = connection()
+    with conn:
+        conn.execute(_SQL_DELETE_SONG, (track_id,))
+
+
+# --- library usage and eviction ---------------------------------------------
+
+_SQL_RECORD_PLAYS = '''
+    UPDATE saved_songs SET play_count = play_count + ?,
+                           last_played_at = MAX(COALESCE(last_played_at, 0), ?)
+    WHERE file_path = ?
+'''
+# One row per stored file; a file shared by several tracks is as used as the most used of them
+_SQL_FILE_USAGE = '''
+    SELECT file_path, MAX(COALESCE(last_played_at, created_at, 0)) AS last_used,
+           SUM(play_count) AS plays
+    FROM saved_songs WHERE file_path IS NOT NULL
+    GROUP BY file_path HAVING MAX(pooled) = 0 AND last_used < ?
+'''
+_SQL_EVICTION_CANDIDATES = {
+    'lru': _SQL_FILE_USAGE + ' ORDER BY last_used, plays LIMIT ?',
+    'lfu': _SQL_FILE_USAGE + ' ORDER BY plays, last_used LIMIT ?',
+}
+EVICTION_POLICIES = tuple(_SQL_EVICTION_CANDIDATES)
+# Checks and deletes in one statement, so a track picked or pooled meanwhile keeps its file
+_SQL_EVICT_FILE = '''
+    DELETE FROM saved_songs WHERE file_path = ?1 AND NOT EXISTS (
+        SELECT 1 FROM saved_songs WHERE file_path = ?1
+        AND (pooled = 1 OR COALESCE(last_played_at, created_at, 0) >= ?2)
+    )
+'''
+
+
+def record_plays(plays):
+    """Apply (play_count increment, last_played_at, file_path) tuples in one transaction."""
+    conn = connection()
+    with conn:
+        conn.executemany(_SQL_RECORD_PLAYS, plays)
+
+
+def eviction_candidates(policy, used_before, limit=100):
+    """Stored files not used since `used_before` and not pooled, least valuable first."""
+    return connection().execute(_SQL_EVICTION_CANDIDATES[policy], (used_before, limit)).fetchall()
+
+
+def evict_file(file_path, used_before):
+    """Delete every row stored at `file_path` unless one was used or pooled since `used_before`.
+
+    Returns the number of rows deleted; 0 means the file must be kept.
+    """
+    conn = connection()
+    with conn:
+        cur = conn.execute(_SQL_EVICT_FILE, (file_path, used_before))
+    return cur.rowcount
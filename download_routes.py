@@ -0,0 +1,150 @@
+"""Song request and download job routes: the `download` role.
+
+`/request_song` looks a track up on Spotify and downloads it through the job
+queue; `/jobs/*` report on those jobs. Jobs live in the process that created
+them, so their URLs only resolve on the same process.
+"""
+import json
+
+from flask import Blueprint, Response, jsonify, request
+
+import jobs
+import pool_keeper
+import spotify_client
+import track_selection
+from track_responses import (
+    MAX_JOB_WAIT_S, audio_response, download_track_and_prepare, progressive_response,
+    queue_download, wants_async, wants_progressive,
+)
+
+bp = Blueprint('download', __name__)
+
+# Comment line sent on idle job event streams to keep proxies from closing them
+SSE_KEEPALIVE_S = 15
+
+
+def start_background():
+    # Keep a few downloaded tracks ready per emotion so POST / can skip spotdl
+    if pool_keeper.EMOTION_POOL_ENABLED and spotify_client.credentials_configured():
+        pool_keeper.pool_keeper.start()
+
+
+@bp.route('/stats/cache')
+def cache_stats():
+    return jsonify({'spotify': spotify_client.cache_stats(), 'selection': track_selection.cache_stats()})
+
+
+@bp.route('/stats/pool')
+def pool_stats():
+    return jsonify({'enabled': pool_keeper.EMOTION_POOL_ENABLED, 'target': pool_keeper.EMOTION_POOL_SIZE,
+                    'ready': pool_keeper.pool_keeper.status()})
+
+
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job.to_dict(request.url_root))
+
+
+@bp.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events: one event per state/progress change until the job finishes."""
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    url_root = request.url_root
+
+    def stream():
+        sent = -1
+        while True:
+            version = job.version
+            if version != sent:
+                sent = version
+                yield f"event: {job.state}\ndata: {json.dumps(job.to_dict(url_root))}\n\n"
+                if job.done:
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            job.wait_for_change(sent, SSE_KEEPALIVE_S)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@bp.route('/jobs/<job_id>/audio')
+def job_audio(job_id):
+    """Audio for a finished job. Answers 202 + Retry-After while the download is running,
+    optionally waiting up to `?wait=` seconds first, so clients never hold a worker for the
+    whole download. With `?progressive=1` the audio is streamed while it downloads.
+    """
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    if wants_progressive() and not job.done:
+        return progressive_response(job.track, job)
+    try:
+        wait = min(float(request.args.get('wait') or 0), MAX_JOB_WAIT_S)
+    except ValueError:
+        wait = 0
+    if wait > 0 and not job.done:
+        job.wait(wait)
+    if job.state == jobs.FAILED:
+        return jsonify(job.to_dict()), 500
+    if not job.done:
+        response = jsonify(job.to_dict())
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
+    return audio_response(job.track, job.result['audio_path'], download_name=job.result['display_name'])
+
+
+@bp.route('/request_song', methods=['POST'])
+def request_song():
+    """Request a specific song by title and/or artist. Accepts JSON or form data with
+    `title` and `artist` fields. Returns the same metadata + file URL as the main endpoint.
+    """
+    data = {}
+    if request.is_json:
+        data = request.get_json() or {}
+    else:
+        data = request.form.to_dict() or request.values.to_dict() or {}
+
+    title = (data.get('title') or request.args.get('title') or '').strip()
+    artist = (data.get('artist') or request.args.get('artist') or '').strip()
+    if not title and not artist:
+        return jsonify({'error': 'Provide at least `title` or `artist` parameter.'}), 400
+
+    if not spotify_client.credentials_configured():
+        return jsonify({'error': 'Server Spotify credentials not configured.'}), 500
+
+
+    # Build a targeted search query. Use Spotify advanced search fields for best match.
+    q_parts = []
+    if title:
+        q_parts.append(f'track:{title}')
+    if artist:
+        q_parts.append(f'artist:{artist}')
+    q = ' '.join(q_parts)
+
+    try:
+        results = spotify_client.search(q, type='track', limit=10)
+        tracks = results.get('tracks', {}).get('items', [])
+    except Exception as e:
+        return jsonify({'error': f'Spotify search failed: {e}'}), 500
+
+    if not tracks:
+        return jsonify({'error': 'No matching tracks found'}), 404
+
+    # Prefer exact-ish matches; for now take the first result
+    track = tracks[0]
+
+    if wants_async():
+        return queue_download(track, q)
+
+    # Delegate download+prepare work to helper
+    resp, code = download_track_and_prepare(track, q)
+    return (jsonify(resp), code) if isinstance(resp, dict) else resp
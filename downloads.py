@@ -0,0 +1,502 @@
+"""Downloading tracks with spotdl into the local `songs/` library.
+
+`fetch_track` is the single place that runs spotdl, validates the MP3 and
+records it in `saved_songs`; the HTTP handlers and the background job queue
+all go through it. `fetch_track_async` is its twin for the asyncio (ASGI)
+path: spotdl runs as an asyncio subprocess and only validation, hashing and
+the database write are handed to a thread.
+"""
+import asyncio
+import base64
+import json
+import mimetypes
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+from urllib.parse import quote
+
+from filelock import FileLock, Timeout
+
+import audio_store
+import db
+import metrics
+import transcode
+
+has_mutagen = True
+try:
+    from mutagen.mp3 import MP3
+    from mutagen import MutagenError
+except Exception as import_err:
+    # mutagen not available in environment; validation will be skipped with a clear error
+    print(f"[import] mutagen import failed: {import_err}")
+    has_mutagen = False
+
+SONGS_DIR = audio_store.SONGS_DIR
+# Per-track lock files that serialise downloads of the same track across processes
+LOCKS_DIR = audio_store.LOCKS_DIR
+DOWNLOAD_LOCK_TIMEOUT_S = float(os.getenv('DOWNLOAD_LOCK_TIMEOUT_S', '600'))
+# Command used to run spotDL; may include arguments (bench/ points it at a fake)
+SPOTDL_BIN = os.getenv('SPOTDL_BIN', 'spotdl')
+# How often a running spotdl process is polled for progress
+_POLL_INTERVAL = 0.5
+_SPOTDL_MISSING = "Error: 'spotdl' command not found or no mp3 produced. Ensure spotDL is installed and accessible."
+
+# Async downloads in flight in this process, by track id
+_inflight_async = {}
+
+
+class DownloadError(Exception):
+    """A track could not be downloaded or failed validation."""
+
+
+def _compact_track(track):
+    # Enough of the Spotify track object to rebuild responses without calling Spotify
+    album = track.get('album', {})
+    return {
+        'id': track.get('id'),
+        'name': track.get('name'),
+        'artists': [{'name': a.get('name', '')} for a in track.get('artists', [])],
+        'album': {
+            'name': album.get('name', ''),
+            'release_date': album.get('release_date', ''),
+            'images': album.get('images', [])[:1],
+        },
+        'popularity': track.get('popularity', 0),
+        'external_urls': {'spotify': track.get('external_urls', {}).get('spotify', '')},
+    }
+
+
+def track_artists(track):
+    return ', '.join(a.get('name', '') for a in track.get('artists', []))
+
+
+def track_filename(track):
+    filename = f"{track.get('name')}_{track_artists(track)}.mp3"
+    return "".join([ch if ch.isalnum() or ch in "._-" else "_" for ch in filename])
+
+
+def is_saved(track_id):
+    return db.is_saved(track_id)
+
+
+def _dir_bytes(path):
+    total = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_file():
+                total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
+
+
+def _growing_mp3(temp_dir):
+    try:
+        mp3s = [e for e in os.scandir(temp_dir) if e.name.lower().endswith('.mp3') and e.is_file()]
+    except OSError:
+        return None
+    if not mp3s:
+        return None
+    return max(mp3s, key=lambda e: e.stat().st_mtime).path
+
+
+def _spotdl_command(url, temp_dir):
+    return [
+        *shlex.split(SPOTDL_BIN),
+        "--output", temp_dir,
+        url
+    ]
+
+
+def _run_spotdl(url, temp_dir, on_progress=None):
+    command = _spotdl_command(url, temp_dir)
+    proc = subprocess.Popen(command)
+    started = time.time()
+    while True:
+        try:
+            returncode = proc.wait(timeout=_POLL_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            if on_progress:
+                on_progress('downloading', bytes_downloaded=_dir_bytes(temp_dir), elapsed_s=round(time.time() - started, 1),
+                            partial_path=_growing_mp3(temp_dir))
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+async def _run_spotdl_async(url, temp_dir):
+    command = _spotdl_command(url, temp_dir)
+    proc = await asyncio.create_subprocess_exec(*command)
+    try:
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def _validate_mp3(audio_path):
+    """Check the file parses as an MP3 with a duration; returns (duration_s, bitrate_bps)."""
+    if not has_mutagen:
+        print("[validation] mutagen is not installed; cannot validate mp3")
+        raise DownloadError("Server-side validation unavailable: mutagen not installed")
+    try:
+        mp = MP3(audio_path)
+        duration = getattr(mp.info, 'length', 0)
+        if not duration:
+            raise MutagenError('MP3 duration is zero')
+        return duration, getattr(mp.info, 'bitrate', None) or None
+    except Exception as e:
+        try:
+            os.remove(audio_path)
+        except Exception:
+            pass
+        print(f"[validation] invalid mp3: {audio_path} -> {e}")
+        raise DownloadError(f"Downloaded file is not a valid MP3: {e}")
+
+
+def _track_lock(track_id):
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    safe_id = "".join(ch if ch.isalnum() else "_" for ch in str(track_id))
+    return FileLock(os.path.join(LOCKS_DIR, f"{safe_id}.lock"), timeout=DOWNLOAD_LOCK_TIMEOUT_S)
+
+
+def fetch_track(track, search_query, on_progress=None, emotion=None):
+    """Make sure `track` is downloaded, validated and recorded in `saved_songs`.
+
+    `on_progress(state, **info)` is called as the download moves through the
+    'downloading' and 'validating' states; while downloading, `partial_path`
+    names the MP3 spotdl is still writing, once there is one. Returns a dict
+    with `saved_msg`, `download_msg`, `filename` (path relative to `songs/`),
+    `display_name` and `audio_path`; raises DownloadError on failure.
+    `emotion` tags the saved row with the emotion label it was picked for.
+
+    Downloads of the same track id are serialised across processes with a lock
+    file; whoever gets the lock second finds the song saved and skips spotdl.
+    """
+    track_id = track.get('id')
+
+    with metrics.timed('db'):
+        row = db.get_song(track_id)
+    if row is not None:
+        metrics.downloads_total.inc('already_saved')
+        return _already_saved(row, track)
+
+    lock = _track_lock(track_id)
+    try:
+        lock.acquire()
+    except Timeout:
+        raise DownloadError(f"Timed out waiting for another download of {track_id}")
+    try:
+        # Another process may have finished this track while we waited for the lock
+        row = db.get_song(track_id)
+        if row is not None:
+            metrics.downloads_total.inc('already_saved')
+            return _already_saved(row, track)
+        try:
+            result = _download(track, search_query, on_progress, emotion)
+        except DownloadError:
+            metrics.downloads_total.inc('failed')
+            raise
+        metrics.downloads_total.inc('downloaded')
+        return result
+    finally:
+        lock.release()
+
+
+def _result(track, filename, saved_msg, download_msg, metadata=None):
+    return {
+        'saved_msg': saved_msg,
+        'download_msg': download_msg,
+        'filename': filename,
+        'display_name': track_filename(track),
+        'audio_path': audio_store.abs_path(filename),
+        # What build_response reports about the file; None means it has to look at the file
+        'metadata': metadata,
+    }
+
+
+def _metadata(file_size, mime, head, renditions=None):
+    return {'file_size': file_size, 'file_mime': mime, 'file_head': head, 'renditions': renditions}
+
+
+def _row_metadata(row):
+    # Rows saved before metadata was recorded at ingest have none until the reconciler fills it in
+    if row['file_head'] is None:
+        return None
+    return _metadata(row['file_size'], row['mime'], row['file_head'], row['renditions'])
+
+
+def _already_saved(row, track):
+    # Rows written before file paths were recorded fall back to the name-derived flat file
+    filename = row['file_path'] or track_filename(track)
+    return _result(track, filename, 'Song already exists in database.',
+                   "Skipping download since the song is already saved.", _row_metadata(row))
+
+
+def _download(track, search_query, on_progress, emotion=None):
+    spotify_url = track.get('external_urls', {}).get('spotify')
+    if on_progress:
+        on_progress('downloading', bytes_downloaded=0, elapsed_s=0)
+    # Create a unique temporary directory per-download so multiple concurrent
+    # downloads (or stale files) in a shared folder don't conflict.
+    temp_dir = tempfile.mkdtemp(prefix="newSong-")
+    try:
+        try:
+            with metrics.timed('spotdl'):
+                _run_spotdl(spotify_url, temp_dir, on_progress)
+        except subprocess.CalledProcessError as e:
+            raise DownloadError(f"Error downloading {spotify_url}: {e}")
+        except FileNotFoundError:
+            raise DownloadError(_SPOTDL_MISSING)
+        return _store_download(track, search_query, temp_dir, on_progress, emotion)
+    finally:
+        # Clean up the temporary folder (remove any leftover files)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _store_download(track, search_query, temp_dir, on_progress=None, emotion=None):
+    """Validate the MP3 spotdl left in `temp_dir`, move it into the store and record it."""
+    track_id = track.get('id')
+    spotify_url = track.get('external_urls', {}).get('spotify')
+    download_msg = f"Successfully downloaded {spotify_url} in mp3 format."
+
+    # Find mp3 files inside the temp directory. There should normally be one,
+    # but if there are multiple we pick the most recently modified file.
+    mp3s = [f for f in os.listdir(temp_dir) if f.lower().endswith('.mp3')]
+    if not mp3s:
+        raise DownloadError(_SPOTDL_MISSING)
+    if len(mp3s) > 1:
+        mp3s.sort(key=lambda fn: os.path.getmtime(os.path.join(temp_dir, fn)), reverse=True)
+    src_mp3 = os.path.join(temp_dir, mp3s[0])
+
+    # Validate before the file enters the store so it only ever holds good MP3s
+    if on_progress:
+        on_progress('validating')
+    with metrics.timed('validate'):
+        duration, bitrate = _validate_mp3(src_mp3)
+    file_size = os.path.getsize(src_mp3)
+    with metrics.timed('ingest'):
+        content_hash, head = audio_store.hash_file(src_mp3)
+    filename = audio_store.key_for(content_hash)
+    mime, _ = mimetypes.guess_type(filename)
+
+    saved_msg = ''
+    # Held until the row exists, so the library manager can't evict a stored copy we deduplicated against
+    with audio_store.store_lock(filename):
+        try:
+            with metrics.timed('ingest'):
+                audio_store.place(src_mp3, filename)
+        except FileNotFoundError:
+            raise DownloadError(_SPOTDL_MISSING)
+        try:
+            with metrics.timed('db'):
+                db.upsert_song(
+                    track_id, track.get('name'), track_artists(track), search_query,
+                    emotion=emotion,
+                    track_json=json.dumps(_compact_track(track)),
+                    file_path=filename,
+                    file_size=file_size,
+                    duration=duration,
+                    content_hash=content_hash,
+                    bitrate=bitrate,
+                    mime=mime,
+                    file_head=head,
+                )
+            saved_msg = 'Song saved to database.'
+        except Exception as e:
+            print(f"[db] failed to insert saved_songs for id={track_id}: {e}")
+
+    # Low-bitrate and HLS renditions are built off the request path
+    transcode.schedule(filename)
+    return _result(track, filename, saved_msg, download_msg, _metadata(file_size, mime, head))
+
+
+async def fetch_track_async(track, search_query, emotion=None):
+    """`fetch_track` for coroutines; same result, errors and locking.
+
+    Concurrent calls for one track share a single download, which keeps going
+    when a waiting client disconnects.
+    """
+    track_id = track.get('id')
+    task = _inflight_async.get(track_id)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_async(track, search_query, emotion))
+        _inflight_async[track_id] = task
+        task.add_done_callback(lambda done: _forget_async(track_id, done))
+    return await asyncio.shield(task)
+
+
+def _forget_async(track_id, task):
+    if _inflight_async.get(track_id) is task:
+        del _inflight_async[track_id]
+    if not task.cancelled():
+        # Retrieved here so a download every client gave up on doesn't log an unhandled error
+        task.exception()
+
+
+async def _fetch_async(track, search_query, emotion):
+    track_id = track.get('id')
+    with metrics.timed('db'):
+        row = await asyncio.to_thread(db.get_song, track_id)
+    if row is not None:
+        metrics.downloads_total.inc('already_saved')
+        return _already_saved(row, track)
+
+    lock = _track_lock(track_id)
+    deadline = time.monotonic() + DOWNLOAD_LOCK_TIMEOUT_S
+    while True:
+        try:
+            lock.acquire(timeout=0)
+            break
+        except Timeout:
+            if time.monotonic() >= deadline:
+                raise DownloadError(f"Timed out waiting for another download of {track_id}")
+            await asyncio.sleep(_POLL_INTERVAL)
+    try:
+        # Another process may have finished this track while we waited for the lock
+        row = await asyncio.to_thread(db.get_song, track_id)
+        if row is not None:
+            metrics.downloads_total.inc('already_saved')
+            return _already_saved(row, track)
+        try:
+            result = await _download_async(track, search_query, emotion)
+        except DownloadError:
+            metrics.downloads_total.inc('failed')
+            raise
+        metrics.downloads_total.inc('downloaded')
+        return result
+    finally:
+        lock.release()
+
+
+async def _download_async(track, search_query, emotion=None):
+    spotify_url = track.get('external_urls', {}).get('spotify')
+    temp_dir = tempfile.mkdtemp(prefix="newSong-")
+    try:
+        try:
+            with metrics.timed('spotdl'):
+                await _run_spotdl_async(spotify_url, temp_dir)
+        except subprocess.CalledProcessError as e:
+            raise DownloadError(f"Error downloading {spotify_url}: {e}")
+        except FileNotFoundError:
+            raise DownloadError(_SPOTDL_MISSING)
+        return await asyncio.to_thread(_store_download, track, search_query, temp_dir, None, emotion)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+
+
+def pool_count(emotion):
+    """Number of pre-downloaded tracks waiting to be served for `emotion`."""
+    return db.pool_count(emotion)
+
+
+def add_to_pool(track, emotion):
+    """Mark an already-saved track as ready to be served for `emotion`.
+
+    Returns False if the track is already waiting in another emotion's pool.
+    """
+    return db.add_to_pool(track.get('id'), emotion, json.dumps(_compact_track(track)))
+
+
+def claim_pooled(emotion):
+    """Take one pre-downloaded track for `emotion` out of the pool.
+
+    Returns (track, result) shaped like `fetch_track`'s output, or None when the
+    pool is empty. Rows whose file went missing are deleted, so the track is
+    downloaded again the next time it is picked.
+    """
+    for row in db.pool_candidates(emotion):
+        # Only one concurrent claimer gets to unpool a given row
+        if not db.unpool(row['id']) or not row['track_json']:
+            continue
+        track = json.loads(row['track_json'])
+        result = _result(track, row['file_path'] or track_filename(track),
+                         'Song already exists in database.', 'Served from the pre-downloaded pool.',
+                         _row_metadata(row))
+        if not os.path.exists(result['audio_path']):
+            # Like catalog.reconcile: a row without its file would keep answering with a dead file_url
+            db.delete_song(row['id'])
+            continue
+        return track, result
+    return None
+
+
+def file_url_for(filename, url_root):
+    # `filename` is relative to songs/ and may contain shard directories
+    return f"{url_root.rstrip('/')}/songs/{quote(filename, safe='/')}"
+
+
+def track_summary(track):
+    return {
+        'name': track.get('name'),
+        'artist': track_artists(track),
+        'album': track.get('album', {}).get('name', ''),
+        'release_date': track.get('album', {}).get('release_date', ''),
+        'popularity': track.get('popularity', 0),
+        'spotify_url': track.get('external_urls', {}).get('spotify', '')
+    }
+
+
+def file_metadata(audio_path):
+    """Size, MIME type and head of a stored file, read from disk (None fields if unreadable)."""
+    file_mime, _ = mimetypes.guess_type(audio_path)
+    file_size = None
+    head = None
+    if os.path.exists(audio_path):
+        try:
+            file_size = os.path.getsize(audio_path)
+            head = audio_store.read_head(audio_path)
+        except Exception as e:
+            print(f"[diagnostic] failed to read file head: {e}")
+    return _metadata(file_size, file_mime, head)
+
+
+def backfill_metadata(track_id, rel_path):
+    """Record the metadata of a row saved before it was captured at ingest."""
+    audio_path = audio_store.abs_path(rel_path)
+    metadata = file_metadata(audio_path)
+    if metadata['file_head'] is None:
+        return False
+    bitrate = None
+    if has_mutagen:
+        try:
+            bitrate = MP3(audio_path).info.bitrate or None
+        except Exception:
+            pass
+    renditions = None
+    if audio_store.is_content_key(rel_path) and transcode.is_ready(rel_path):
+        renditions = transcode.encode_bitrates(transcode.built_bitrates(rel_path))
+    db.set_audio_metadata(track_id, metadata['file_size'], metadata['file_mime'], metadata['file_head'],
+                          bitrate=bitrate, renditions=renditions)
+    return True
+
+
+def build_response(track, result, url_root):
+    """JSON body returned to clients once `fetch_track` has produced a file.
+
+    Built from the metadata recorded in the catalog; only results for rows that
+    predate it read the file.
+    """
+    metadata = result.get('metadata')
+    if metadata is None:
+        metadata = file_metadata(result['audio_path'])
+        renditions = transcode.describe(result['filename'], url_root)
+    else:
+        renditions = transcode.describe_recorded(result['filename'], metadata['renditions'], url_root)
+    head = metadata['file_head']
+    return {
+        'track': track_summary(track),
+        'saved_msg': result['saved_msg'],
+        'download_msg': result['download_msg'],
+        'file_url': file_url_for(result['filename'], url_root),
+        'file_mime': metadata['file_mime'],
+        'file_size': metadata['file_size'],
+        'file_head_b64': base64.b64encode(head).decode('ascii') if head is not None else None,
+        # None until the background transcode has finished
+        'renditions': renditions,
+    }
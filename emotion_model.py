@@ -0,0 +1,268 @@
+"""Emotion model loading, warm-up and inference for the photo endpoint.
+
+The DeepFace emotion model and face detector are built once per process by
+`warm_up()` and kept in DeepFace's own model cache, so requests never pay for
+graph building or weight loading.
+
+DeepFace (and with it TensorFlow), OpenCV and NumPy are imported on first use
+rather than at import time, so processes that only need `EMOTION_LABELS` (the
+pool keeper, the audio server) start fast and never load TensorFlow.
+"""
+import os
+import threading
+import time
+
+from inference_batcher import MicroBatcher
+
+# Same detector DeepFace.analyze uses by default; override to trade speed for accuracy.
+DETECTOR_BACKEND = os.getenv('DETECTOR_BACKEND', 'opencv')
+# Detector used when the frame was already cropped to a client-supplied face box.
+CROPPED_DETECTOR_BACKEND = os.getenv('CROPPED_DETECTOR_BACKEND', 'skip')
+
+# Faces from concurrent requests are classified together on one inference thread.
+# Set INFERENCE_BATCHING=0 to fall back to a DeepFace.analyze call per request.
+INFERENCE_BATCHING = os.getenv('INFERENCE_BATCHING', '1') == '1'
+INFERENCE_MAX_BATCH = int(os.getenv('INFERENCE_MAX_BATCH', '16'))
+INFERENCE_MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', '5'))
+# TensorFlow thread pools. With a single inference thread the intra-op pool can
+# use every core; keep inter-op small so concurrent ops don't oversubscribe.
+TF_INTRA_OP_THREADS = int(os.getenv('TF_INTRA_OP_THREADS', str(os.cpu_count() or 1)))
+TF_INTER_OP_THREADS = int(os.getenv('TF_INTER_OP_THREADS', '1'))
+
+# Output order of DeepFace's emotion model
+EMOTION_LABELS = ('angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral')
+# Input side of the emotion model (48x48 grayscale)
+_MODEL_SIDE = 48
+# Weight given to a frame where no face was detected, relative to a detected one
+_NO_FACE_WEIGHT = 0.05
+
+_ready = threading.Event()
+_state_lock = threading.Lock()
+_warmup_thread = None
+_warmup_state = {
+    'started_at': None,
+    'finished_at': None,
+    'duration_s': None,
+    'error': None,
+}
+
+
+def _deepface():
+    from deepface import DeepFace
+    return DeepFace
+
+
+def configure_tf_threads(intra_op=None, inter_op=None):
+    """Apply TensorFlow thread-pool sizes. Must run before TF executes its first op."""
+    import tensorflow as tf
+    intra_op = TF_INTRA_OP_THREADS if intra_op is None else intra_op
+    inter_op = TF_INTER_OP_THREADS if inter_op is None else inter_op
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+        print(f"[warmup] TF threads intra_op={intra_op} inter_op={inter_op}")
+    except RuntimeError as e:
+        # TF was already initialised (e.g. by an earlier import); keep its settings
+        print(f"[warmup] could not set TF thread counts: {e}")
+
+
+def detect_emotion_from_frame(frame, cropped=False):
+    import numpy as np
+    try:
+        if INFERENCE_BATCHING:
+            face, _ = extract_face(frame, cropped=cropped)
+            probs = _batcher.submit(face).result()
+            return EMOTION_LABELS[int(np.argmax(probs))]
+        result = _deepface().analyze(
+            frame,
+            actions=['emotion'],
+            enforce_detection=False,
+            detector_backend=CROPPED_DETECTOR_BACKEND if cropped else DETECTOR_BACKEND,
+            silent=True,
+        )
+        if isinstance(result, list):
+            emotion = result[0]['dominant_emotion']
+        else:
+            emotion = result['dominant_emotion']
+        return emotion
+    except Exception as e:
+        return f"Error detecting emotion: {str(e)}"
+
+
+def _emotion_model():
+    # DeepFace caches built models, so this is a dict lookup after warm-up
+    return _deepface().build_model(model_name='Emotion', task='facial_attribute')
+
+
+def extract_face(frame, cropped=False):
+    """Return (face, detection_confidence) for the largest face in `frame`.
+
+    `face` is an RGB float array in [0, 1]. When nothing is detected the whole
+    frame comes back with a confidence of 0.
+    """
+    faces = _deepface().extract_faces(
+        frame,
+        detector_backend=CROPPED_DETECTOR_BACKEND if cropped else DETECTOR_BACKEND,
+        enforce_detection=False,
+        align=True,
+    )
+    best = max(faces, key=lambda f: f['facial_area']['w'] * f['facial_area']['h'])
+    return best['face'], float(best.get('confidence') or 0.0)
+
+
+def _to_model_input(face):
+    # Mirrors DeepFace's own preprocessing: RGB -> BGR, pad to square, gray 48x48
+    import cv2
+    import numpy as np
+    face = np.asarray(face, dtype=np.float32)
+    if face.max() > 1:
+        face = face / 255.0
+    gray = cv2.cvtColor(np.ascontiguousarray(face[:, :, ::-1]), cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    side = max(height, width)
+    square = np.zeros((side, side), dtype=np.float32)
+    top, left = (side - height) // 2, (side - width) // 2
+    square[top:top + height, left:left + width] = gray
+    return cv2.resize(square, (_MODEL_SIDE, _MODEL_SIDE))[..., np.newaxis]
+
+
+def predict_emotions(faces):
+    """Run the emotion classifier on a list of faces in a single forward pass.
+
+    Returns an (N, len(EMOTION_LABELS)) array of probabilities, one row per face.
+    """
+    import numpy as np
+    batch = np.stack([_to_model_input(face) for face in faces])
+    preds = np.asarray(_emotion_model().model(batch, training=False), dtype=np.float64)
+    totals = preds.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.0
+    return preds / totals
+
+
+def combine_votes(probs, detection_confidences, vote='weighted'):
+    """Combine per-frame emotion probabilities into one result.
+
+    `mean` averages the rows; `weighted` weights each frame by its top
+    probability and by whether a face was actually detected in it.
+    """
+    import numpy as np
+    probs = np.asarray(probs, dtype=np.float64)
+    if vote == 'mean':
+        weights = np.ones(len(probs))
+    else:
+        detected = np.asarray([c if c > 0 else _NO_FACE_WEIGHT for c in detection_confidences])
+        weights = probs.max(axis=1) * detected
+        if not weights.sum():
+            weights = np.ones(len(probs))
+    combined = (probs * weights[:, np.newaxis]).sum(axis=0) / weights.sum()
+    return {
+        'dominant_emotion': EMOTION_LABELS[int(combined.argmax())],
+        'emotion': {label: round(float(p) * 100, 2) for label, p in zip(EMOTION_LABELS, combined)},
+        'per_frame': [EMOTION_LABELS[int(row.argmax())] for row in probs],
+        'vote': vote,
+    }
+
+
+_batcher = MicroBatcher(
+    predict_emotions,
+    max_batch_size=INFERENCE_MAX_BATCH,
+    max_wait_ms=INFERENCE_MAX_WAIT_MS,
+    name='emotion',
+)
+
+
+def batcher_stats():
+    return dict(_batcher.stats, enabled=INFERENCE_BATCHING)
+
+
+def detect_emotion_from_frames(frames, vote='weighted'):
+    """Detect faces in every frame, classify them as one batch and vote."""
+    faces, confidences = [], []
+    for frame in frames:
+        face, confidence = extract_face(frame)
+        faces.append(face)
+        confidences.append(confidence)
+    if INFERENCE_BATCHING and len(faces) <= INFERENCE_MAX_BATCH:
+        probs = [fut.result() for fut in _batcher.submit_many(faces)]
+    else:
+        probs = predict_emotions(faces)
+    return combine_votes(probs, confidences, vote=vote)
+
+
+def warm_up():
+    """Build the emotion model and face detector and run one dummy inference.
+
+    Safe to call more than once; only the first successful call does any work.
+    """
+    if _ready.is_set():
+        return True
+    started = time.time()
+    with _state_lock:
+        _warmup_state['started_at'] = started
+        _warmup_state['error'] = None
+    try:
+        import numpy as np
+        configure_tf_threads()
+        DeepFace = _deepface()
+        DeepFace.build_model(model_name='Emotion', task='facial_attribute')
+        DeepFace.build_model(model_name=DETECTOR_BACKEND, task='face_detector')
+        # A blank frame still runs detection + the emotion forward pass with
+        # enforce_detection=False, which is what forces TF to trace the graph.
+        dummy = np.zeros((224, 224, 3), dtype=np.uint8)
+        result = detect_emotion_from_frame(dummy)
+        if result.startswith("Error"):
+            raise RuntimeError(result)
+    except Exception as e:
+        with _state_lock:
+            _warmup_state['error'] = str(e)
+        print(f"[warmup] emotion model warm-up failed: {e}")
+        return False
+
+    finished = time.time()
+    with _state_lock:
+        _warmup_state['finished_at'] = finished
+        _warmup_state['duration_s'] = round(finished - started, 3)
+    _ready.set()
+    print(f"[warmup] emotion model ready in {finished - started:.2f}s (detector={DETECTOR_BACKEND})")
+    return True
+
+
+def preload():
+    """Import DeepFace and its libraries without running the model.
+
+    Meant for the master of a pre-forking server: the imported libraries, the
+    bulk of a worker's memory, are then shared copy-on-write by all workers.
+    TensorFlow's runtime does not survive fork(), so no op may run here; each
+    worker still builds its own session with `warm_up()` after forking.
+    """
+    started = time.time()
+    # DeepFace pulls in TensorFlow/Keras, OpenCV and NumPy itself
+    _deepface()
+    print(f"[warmup] preloaded DeepFace/TensorFlow in {time.time() - started:.2f}s")
+
+
+def start_warm_up():
+    """Run `warm_up()` on a background thread so the server can bind immediately."""
+    global _warmup_thread
+    with _state_lock:
+        if _warmup_thread is not None and _warmup_thread.is_alive():
+            return _warmup_thread
+        _warmup_thread = threading.Thread(target=warm_up, name='emotion-warmup', daemon=True)
+        _warmup_thread.start()
+        return _warmup_thread
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def readiness():
+    """Snapshot of the warm-up state for the /ready endpoint."""
+    with _state_lock:
+        state = dict(_warmup_state)
+    state['ready'] = _ready.is_set()
+    state['detector_backend'] = DETECTOR_BACKEND
+    state['batching'] = batcher_stats()
+    return state
@@ -0,0 +1,178 @@
+"""Cache of detected emotions for near-duplicate webcam frames.
+
+The webcam client often sends almost the same frame again (a retry, or the
+same person holding the same expression). Entries are keyed by a 64-bit
+perceptual hash of where the face is, found without running the detector:
+the whole frame when it was cropped to the client's face box, otherwise its
+central FRAME_CACHE_CENTRE share, where webcam framing puts the face. Hashing
+the whole frame would let the background decide the match. A lookup accepts
+a stored region within FRAME_CACHE_MAX_DISTANCE differing bits (dHash by
+default, aHash with FRAME_HASH=ahash), so such a frame skips detection and
+inference entirely. Entries expire after FRAME_CACHE_TTL_S; beyond
+FRAME_CACHE_SIZE the least recently matched one is dropped.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import emotion_model
+
+FRAME_CACHE_ENABLED = os.getenv('FRAME_CACHE', '1') == '1'
+FRAME_CACHE_SIZE = int(os.getenv('FRAME_CACHE_SIZE', '512'))
+FRAME_CACHE_TTL_S = float(os.getenv('FRAME_CACHE_TTL_S', '60'))
+# Hamming distance (out of 64 bits) still treated as the same face; 0 is exact matches only.
+# Kept tight: a few bits are enough to tell one expression from another.
+FRAME_CACHE_MAX_DISTANCE = int(os.getenv('FRAME_CACHE_MAX_DISTANCE', '1'))
+# dHash by default: it follows edges (mouth, brows) and ignores global brightness,
+# where aHash mostly records which half of the face is lit
+FRAME_HASH = os.getenv('FRAME_HASH', 'dhash')
+# Share of an uncropped frame's width and height that is hashed, around its centre
+FRAME_CACHE_CENTRE = float(os.getenv('FRAME_CACHE_CENTRE', '0.5'))
+
+
+def _gray(frame, width, height):
+    import cv2
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def _bits_to_int(bits):
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(frame):
+    """Difference hash: whether each pixel of a 9x8 thumbnail is brighter than its left neighbour."""
+    small = _gray(frame, 9, 8).astype('int16')
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def ahash(frame):
+    """Average hash: whether each pixel of an 8x8 thumbnail is brighter than the mean."""
+    small = _gray(frame, 8, 8)
+    return _bits_to_int(small > small.mean())
+
+
+HASHES = {'dhash': dhash, 'ahash': ahash}
+if FRAME_HASH not in HASHES:
+    raise ValueError(f"FRAME_HASH must be one of: {', '.join(HASHES)}")
+
+
+def key_region(frame, cropped=False):
+    """The part of `frame` its cache key is hashed from: all of a face-box crop, else the centre."""
+    if cropped:
+        return frame
+    height, width = frame.shape[:2]
+    h, w = max(1, int(height * FRAME_CACHE_CENTRE)), max(1, int(width * FRAME_CACHE_CENTRE))
+    top, left = (height - h) // 2, (width - w) // 2
+    return frame[top:top + h, left:left + w]
+
+
+class PerceptualCache:
+    """Values keyed by 64-bit perceptual hashes, matched by Hamming distance.
+
+    `scope` separates hashes that must never match each other (e.g. frames
+    cropped to a face box versus whole frames).
+    """
+
+    def __init__(self, maxsize=FRAME_CACHE_SIZE, ttl=FRAME_CACHE_TTL_S,
+                 max_distance=FRAME_CACHE_MAX_DISTANCE, name='frames'):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.max_distance = int(max_distance)
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, frame_hash, scope=None):
+        """Cached value for the closest stored hash within `max_distance`, else None."""
+        now = time.monotonic()
+        with self._lock:
+            key = (scope, frame_hash)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                self._data.move_to_end(key)
+                self.exact_hits += 1
+                return entry[0]
+            best_key, best_distance = None, self.max_distance + 1
+            expired = []
+            for (entry_scope, entry_hash), (_, expires_at) in self._data.items():
+                if expires_at <= now:
+                    expired.append((entry_scope, entry_hash))
+                    continue
+                if entry_scope != scope:
+                    continue
+                distance = (entry_hash ^ frame_hash).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = (entry_scope, entry_hash), distance
+            for stale in expired:
+                del self._data[stale]
+            self.expirations += len(expired)
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(best_key)
+            self.near_hits += 1
+            return self._data[best_key][0]
+
+    def set(self, frame_hash, value, scope=None):
+        # Expiry is fixed at insertion; matching an entry does not extend its life
+        with self._lock:
+            key = (scope, frame_hash)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.near_hits
+            lookups = hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl_s': self.ttl,
+                'max_distance': self.max_distance,
+                'hash': FRAME_HASH,
+                'exact_hits': self.exact_hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(hits / lookups, 4) if lookups else None,
+            }
+
+
+_cache = PerceptualCache()
+
+
+def detect_emotion(frame, cropped=False):
+    """`emotion_model.detect_emotion_from_frame` behind the cache. Returns (emotion, cache_hit)."""
+    if not FRAME_CACHE_ENABLED:
+        return emotion_model.detect_emotion_from_frame(frame, cropped=cropped), False
+    frame_hash = HASHES[FRAME_HASH](key_region(frame, cropped))
+    emotion = _cache.get(frame_hash, scope=cropped)
+    if emotion is not None:
+        return emotion, True
+    emotion = emotion_model.detect_emotion_from_frame(frame, cropped=cropped)
+    # Errors are not cached so the next frame gets a fresh attempt
+    if not emotion.startswith("Error"):
+        _cache.set(frame_hash, emotion, scope=cropped)
+    return emotion, False
+
+
+def stats():
+    return dict(_cache.stats(), enabled=FRAME_CACHE_ENABLED)
@@ -0,0 +1,141 @@
+"""Decoding and preprocessing of uploaded photos before emotion inference.
+
+Large webcam JPEGs are decoded at a reduced scale (libjpeg can skip most of the
+IDCT work with the IMREAD_REDUCED_* modes) and capped to `MAX_SIDE` pixels on
+their longest side. A client-supplied face box is used to crop the frame so
+the detector only has to look at the face. OpenCV and NumPy are imported on
+first use.
+"""
+import os
+import struct
+
+# Longest side (in pixels) handed to the emotion model.
+MAX_SIDE = int(os.getenv('EMOTION_MAX_SIDE', '640'))
+# Extra context kept around a client-supplied face box, as a fraction of its size.
+FACE_BOX_MARGIN = float(os.getenv('FACE_BOX_MARGIN', '0.2'))
+
+
+def image_size(data):
+    """Return (width, height) read from a JPEG or PNG header, or None if unknown.
+
+    Only the header is inspected so this is cheap to call before decoding.
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    n = len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        seg_len = struct.unpack('>H', data[i + 2:i + 4])[0]
+        # SOFn markers (excluding DHT/JPG/DAC) carry the frame dimensions
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        if marker == 0xDA:
+            return None
+        i += 2 + seg_len
+    return None
+
+
+def parse_face_box(value):
+    """Parse an "x,y,w,h" face box (original image pixels). Returns a tuple or None."""
+    if not value:
+        return None
+    try:
+        parts = [int(round(float(p))) for p in str(value).replace(' ', '').split(',')]
+    except ValueError:
+        return None
+    if len(parts) != 4 or parts[2] <= 0 or parts[3] <= 0:
+        return None
+    return tuple(parts)
+
+
+def _choose_reduction(size, max_side):
+    import cv2
+    if size is None:
+        return 1, cv2.IMREAD_COLOR
+    longest = max(size)
+    reduced_modes = (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    )
+    for factor, mode in reduced_modes:
+        # never reduce below the cap; the final resize handles the remainder
+        if longest // factor >= max_side:
+            return factor, mode
+    return 1, cv2.IMREAD_COLOR
+
+
+def _crop(frame, box, scale):
+    x, y, w, h = (v / scale for v in box)
+    mx, my = w * FACE_BOX_MARGIN, h * FACE_BOX_MARGIN
+    height, width = frame.shape[:2]
+    x0 = max(0, int(x - mx))
+    y0 = max(0, int(y - my))
+    x1 = min(width, int(x + w + mx))
+    y1 = min(height, int(y + h + my))
+    if x1 - x0 < 8 or y1 - y0 < 8:
+        return None
+    return frame[y0:y1, x0:x1]
+
+
+def decode_photo(data, face_box=None, max_side=None):
+    """Decode uploaded image bytes into a BGR frame ready for emotion inference.
+
+    Returns (frame, info) where `info` describes the sizes chosen for this
+    request. `frame` is None when the bytes could not be decoded.
+    """
+    import cv2
+    import numpy as np
+    max_side = max_side or MAX_SIDE
+    size = image_size(data)
+    factor, mode = _choose_reduction(size, max_side)
+    buf = np.frombuffer(data, np.uint8)
+    frame = cv2.imdecode(buf, mode)
+    if frame is None and mode != cv2.IMREAD_COLOR:
+        factor = 1
+        frame = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    info = {
+        'original_size': list(size) if size else None,
+        'reduction': factor,
+        'decoded_size': None,
+        'inference_size': None,
+        'face_box': list(face_box) if face_box else None,
+        'cropped': False,
+    }
+    if frame is None:
+        return None, info
+
+    height, width = frame.shape[:2]
+    info['decoded_size'] = [width, height]
+    if info['original_size'] is None:
+        info['original_size'] = [width * factor, height * factor]
+
+    scale = float(factor)
+    longest = max(width, height)
+    if longest > max_side:
+        ratio = max_side / float(longest)
+        frame = cv2.resize(frame, (max(1, int(width * ratio)), max(1, int(height * ratio))), interpolation=cv2.INTER_AREA)
+        scale /= ratio
+
+    if face_box:
+        cropped = _crop(frame, face_box, scale)
+        if cropped is not None:
+            frame = cropped
+            info['cropped'] = True
+
+    info['inference_size'] = [frame.shape[1], frame.shape[0]]
+    return frame, info
@@ -0,0 +1,49 @@
+"""gunicorn settings for serving `wsgi:app`.
+
+Run from the repository root with `gunicorn -c gunicorn.conf.py` (gunicorn
+also picks this file up by itself when started there). Every setting can be
+overridden through the environment; defaults scale with the core count.
+"""
+import os
+
+cores = os.cpu_count() or 1
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:5000')
+wsgi_app = 'wsgi:app'
+
+# Build the app and import DeepFace/TensorFlow once in the master, so workers
+# share those pages copy-on-write instead of each loading their own copy
+preload_app = True
+
+# One worker per core: each runs inference on its own TensorFlow session, and
+# extra workers cost little memory because the libraries are shared
+workers = int(os.getenv('WEB_CONCURRENCY', str(max(1, min(cores, int(os.getenv('GUNICORN_MAX_WORKERS', '8')))))))
+# Threads per worker. Requests mostly wait on downloads, Spotify or streaming
+# audio out, so a worker handles several at once
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# Synchronous /request_song and photo requests may wait for a whole download
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Split the cores between the workers' TensorFlow pools, and the download
+# concurrency between their job queues, instead of giving each worker all of
+# them. Set here because the modules read these at import, in the master.
+os.environ.setdefault('TF_INTRA_OP_THREADS', str(max(1, cores // workers)))
+os.environ.setdefault('TF_INTER_OP_THREADS', '1')
+os.environ.setdefault('DOWNLOAD_WORKERS', str(max(1, -(-max(4, cores) // workers))))
+
+
+def post_fork(server, worker):
+    # Nothing below may be inherited from the master: SQLite connections and
+    # thread pools do not survive fork(), and TensorFlow must not have run yet
+    import app_factory
+    import db
+    import spotify_client
+    import wsgi
+
+    db.close()
+    spotify_client.reset()
+    app_factory.start_background(wsgi.app.config['ROLES'])
+    server.log.info('worker %s started background work', worker.pid)
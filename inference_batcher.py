@@ -0,0 +1,75 @@
+"""In-process micro-batching for model inference.
+
+Request threads submit single items and block on a Future; one dedicated
+inference thread drains the queue into batches of at most `max_batch_size`
+items, waiting no longer than `max_wait_ms` for a batch to fill, and runs them
+through `predict_fn` together.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5, name='inference'):
+        """`predict_fn` takes a list of items and returns a sequence of results in the same order."""
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms) / 1000.0)
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'items': 0, 'max_batch_seen': 0}
+
+    def _ensure_started(self):
+        # Started lazily so a forking server gets its thread in each worker
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f'{self.name}-batcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        fut = Future()
+        self._ensure_started()
+        self._queue.put((item, fut))
+        return fut
+
+    def submit_many(self, items):
+        # Enqueued back to back so they normally land in the same batch
+        return [self.submit(item) for item in items]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [fut for _, fut in batch]
+            try:
+                results = self.predict_fn(items)
+                for fut, result in zip(futures, results):
+                    fut.set_result(result)
+            except Exception as e:
+                print(f"[{self.name}] batch of {len(items)} failed: {e}")
+                for fut in futures:
+                    if not fut.done():
+                        fut.set_exception(e)
+            self.stats['batches'] += 1
+            self.stats['items'] += len(items)
+            self.stats['max_batch_seen'] = max(self.stats['max_batch_seen'], len(items))
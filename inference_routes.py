@@ -0,0 +1,178 @@
+"""Photo routes: the `inference` role.
+
+`POST /` and `POST /frames` detect an emotion and answer with a song for it.
+The song is picked and downloaded in this process, so this role is always
+served together with `download` (whose `/jobs/*` routes the async answers
+point at). The emotion model is loaded in the background at startup.
+"""
+import os
+
+from flask import Blueprint, jsonify, request
+
+import downloads
+import emotion_model
+import frame_cache
+import jobs
+import metrics
+import pool_keeper
+import spotify_client
+import track_selection
+from frames import decode_photo, parse_face_box
+from track_responses import (
+    fetch_via_queue, job_accepted, progressive_response, queue_download, respond_with_track,
+    wants_async, wants_progressive,
+)
+
+bp = Blueprint('inference', __name__)
+
+# Upper bound on frames accepted by POST /frames in one request
+MAX_FRAMES = int(os.getenv('MAX_FRAMES', '16'))
+
+
+def start_background():
+    # Build and warm the emotion model in the background so the first photo request
+    # doesn't pay for TensorFlow graph building; /ready reports when that's done.
+    emotion_model.start_warm_up()
+
+
+@metrics.register_collector
+def _batcher_metrics():
+    stats = emotion_model.batcher_stats()
+    return [
+        ('hwgide_inference_batches_total', 'counter', 'Micro-batches run by the emotion model.', [({}, stats['batches'])]),
+        ('hwgide_inference_items_total', 'counter', 'Faces classified through the micro-batcher.', [({}, stats['items'])]),
+    ]
+
+
+@metrics.register_collector
+def _frame_cache_metrics():
+    stats = frame_cache.stats()
+    lookups = [({'result': 'exact'}, stats['exact_hits']), ({'result': 'near'}, stats['near_hits']),
+               ({'result': 'miss'}, stats['misses'])]
+    return [
+        ('hwgide_frame_cache_lookups_total', 'counter', 'Emotion lookups by perceptual frame hash.', lookups),
+        ('hwgide_frame_cache_evictions_total', 'counter', 'Frame cache entries dropped for space.', [({}, stats['evictions'])]),
+        ('hwgide_frame_cache_entries', 'gauge', 'Frames held in the emotion cache.', [({}, stats['size'])]),
+    ]
+
+
+@bp.route('/ready')
+def ready():
+    state = emotion_model.readiness()
+    return jsonify(state), (200 if state['ready'] else 503)
+
+
+@bp.route('/stats/frame_cache')
+def frame_cache_stats():
+    return jsonify(frame_cache.stats())
+
+
+@bp.route('/', methods=['POST'])
+def get_song():
+    if 'photo' not in request.files:
+        return jsonify({'error': 'photo file is required'}), 400
+
+    photo = request.files['photo']
+    # Optional "x,y,w,h" face box from the client, in original image pixels
+    face_box = parse_face_box(request.form.get('face_box') or request.args.get('face_box'))
+    with metrics.timed('decode'):
+        frame, preprocess = decode_photo(photo.read(), face_box=face_box)
+    print(f"[preprocess] original={preprocess['original_size']} reduction={preprocess['reduction']} inference={preprocess['inference_size']} cropped={preprocess['cropped']}")
+    if frame is None:
+        return jsonify({'error': 'photo could not be decoded as an image', 'preprocess': preprocess}), 400
+    with metrics.timed('inference'):
+        emotion, cache_hit = frame_cache.detect_emotion(frame, cropped=preprocess['cropped'])
+    if emotion.startswith("Error"):
+        return jsonify({'error': emotion}), 500
+    inference_size = 'x'.join(str(v) for v in preprocess['inference_size'])
+    return _song_for_emotion(
+        emotion,
+        extra={'emotion': emotion, 'preprocess': preprocess, 'emotion_cached': cache_hit},
+        extra_headers={'X-Inference-Size': inference_size, 'X-Emotion-Cache': 'hit' if cache_hit else 'miss'},
+    )
+
+
+@bp.route('/frames', methods=['POST'])
+def get_song_from_frames():
+    """Like `POST /` but takes several frames (repeated `photo` or `photos` fields).
+    Faces from every frame go through the emotion model in a single batch and the
+    per-frame probabilities are combined (`vote=mean` or `vote=weighted`, default weighted).
+    """
+    photos = request.files.getlist('photos') + request.files.getlist('photo')
+    if not photos:
+        return jsonify({'error': 'at least one photo (or photos) file is required'}), 400
+    if len(photos) > MAX_FRAMES:
+        return jsonify({'error': f'too many frames; at most {MAX_FRAMES} are accepted'}), 400
+    vote = (request.form.get('vote') or request.args.get('vote') or 'weighted').lower()
+    if vote not in ('mean', 'weighted'):
+        return jsonify({'error': 'vote must be "mean" or "weighted"'}), 400
+
+    frames = []
+    for photo in photos:
+        with metrics.timed('decode'):
+            frame, preprocess = decode_photo(photo.read())
+        if frame is None:
+            print(f"[frames] skipping undecodable frame {photo.filename}")
+            continue
+        frames.append(frame)
+    if not frames:
+        return jsonify({'error': 'none of the photos could be decoded as an image'}), 400
+
+    try:
+        with metrics.timed('inference'):
+            votes = emotion_model.detect_emotion_from_frames(frames, vote=vote)
+    except Exception as e:
+        return jsonify({'error': f"Error detecting emotion: {str(e)}"}), 500
+    emotion = votes['dominant_emotion']
+    print(f"[frames] {len(frames)} frames -> {emotion} ({vote})")
+    return _song_for_emotion(
+        emotion,
+        extra={'emotion': emotion, 'emotion_votes': votes},
+        extra_headers={'X-Frames-Used': str(len(frames))},
+    )
+
+
+def _song_for_emotion(emotion, extra=None, extra_headers=None):
+    """Pick, download and return a song for a detected emotion. `extra` is merged into
+    the JSON body and `extra_headers` into the streamed audio response.
+    """
+    extra = extra or {}
+    extra_headers = extra_headers or {}
+    search_query = emotion
+
+    # Serve a pre-downloaded track when the pool has one; the keeper replaces it
+    if pool_keeper.EMOTION_POOL_ENABLED:
+        with metrics.timed('pool_claim'):
+            claimed = downloads.claim_pooled(emotion)
+        if claimed is not None:
+            pool_keeper.pool_keeper.request_refill(emotion)
+            track, result = claimed
+            track_selection.mark_played(track['id'])
+            return respond_with_track(track, result, extra, extra_headers)
+
+    if not spotify_client.credentials_configured():
+        return jsonify({'error': 'Server Spotify credentials not configured.'}), 500
+
+    try:
+        with metrics.timed('selection'):
+            track = track_selection.pick_track(search_query)
+    except track_selection.SelectionError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': f'Spotify search failed: {e}'}), 500
+
+    if wants_async():
+        return queue_download(track, search_query, extra, emotion=emotion)
+
+    # Start sending audio while spotdl is still writing the file
+    if request.headers.get('X-Return-Audio') == '1' and wants_progressive():
+        job = jobs.job_queue.submit(track, search_query, emotion=emotion)
+        return progressive_response(track, job, extra_headers)
+
+    result, error, job = fetch_via_queue(track, search_query, emotion=emotion)
+    if error:
+        return jsonify({'error': error}), 500
+    if result is None:
+        # Still downloading and the client takes async answers: point it at the job
+        return job_accepted(job, extra)
+    return respond_with_track(track, result, extra, extra_headers)
@@ -0,0 +1,164 @@
+"""Background download jobs.
+
+A bounded pool of worker threads runs `downloads.fetch_track`. Each request
+for a track gets a `Job` record that moves through
+queued -> downloading -> validating -> ready | failed, which HTTP clients can
+poll (`GET /jobs/<id>`) or follow as server-sent events.
+
+Jobs are single-flight per track id: while a download for a track is in
+flight, further submissions for it get the existing job back.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import downloads
+
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+# Finished jobs are kept around this long so clients can still poll them
+JOB_RETENTION_S = int(os.getenv('JOB_RETENTION_S', '900'))
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+VALIDATING = 'validating'
+READY = 'ready'
+FAILED = 'failed'
+FINAL_STATES = (READY, FAILED)
+
+
+class Job:
+    def __init__(self, track, search_query, emotion=None):
+        self.id = uuid.uuid4().hex
+        self.track = track
+        self.track_id = track.get('id')
+        self.search_query = search_query
+        self.emotion = emotion
+        self.state = QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        # The file spotdl is still writing, for progressive streaming; never sent to clients
+        self.partial_path = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # Bumped on every change so event streams can wait for the next one
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def _update(self, state, **fields):
+        with self._cond:
+            self.state = state
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.updated_at = time.time()
+            self.version += 1
+            self._cond.notify_all()
+
+    def report(self, state, **info):
+        """Progress callback handed to `downloads.fetch_track`."""
+        partial_path = info.pop('partial_path', None)
+        if partial_path:
+            self._update(state, progress=info, partial_path=partial_path)
+        else:
+            self._update(state, progress=info)
+
+    @property
+    def done(self):
+        return self.state in FINAL_STATES
+
+    def wait(self, timeout=None):
+        """Block until the job is ready or failed. Returns True if it finished."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self.done:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def wait_for_change(self, version, timeout):
+        """Block until `self.version` moves past `version` or `timeout` expires."""
+        with self._cond:
+            if self.version == version and not self.done:
+                self._cond.wait(timeout)
+            return self.version
+
+    def to_dict(self, url_root=None):
+        data = {
+            'job_id': self.id,
+            'track_id': self.track_id,
+            'state': self.state,
+            'progress': self.progress,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'track': downloads.track_summary(self.track),
+        }
+        if self.error:
+            data['error'] = self.error
+        if self.state == READY and self.result and url_root:
+            data.update(downloads.build_response(self.track, self.result, url_root))
+        return data
+
+
+class JobQueue:
+    def __init__(self, max_workers=DOWNLOAD_WORKERS):
+        self.max_workers = max_workers
+        self._jobs = {}
+        # track id -> job still queued or downloading
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        # Created on first use so forked workers each get their own threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='download')
+        return self._executor
+
+    def submit(self, track, search_query, emotion=None):
+        """Queue a download, or attach to the one already in flight for this track."""
+        track_id = track.get('id')
+        with self._lock:
+            running = self._inflight.get(track_id)
+            if running is not None and not running.done:
+                print(f"[jobs] attaching to in-flight job {running.id} for {track_id}")
+                return running
+            self._prune()
+            job = Job(track, search_query, emotion)
+            self._jobs[job.id] = job
+            if track_id:
+                self._inflight[track_id] = job
+            self._pool().submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_S
+        stale = [jid for jid, job in self._jobs.items() if job.done and job.updated_at < cutoff]
+        for jid in stale:
+            del self._jobs[jid]
+
+    def _run(self, job):
+        try:
+            result = downloads.fetch_track(job.track, job.search_query, on_progress=job.report, emotion=job.emotion)
+            job._update(READY, result=result, progress={})
+            print(f"[jobs] {job.id} ready: {result['filename']}")
+        except downloads.DownloadError as e:
+            job._update(FAILED, error=str(e))
+            print(f"[jobs] {job.id} failed: {e}")
+        except Exception as e:
+            job._update(FAILED, error=f"Unexpected download error: {e}")
+            print(f"[jobs] {job.id} crashed: {e}")
+        finally:
+            with self._lock:
+                if self._inflight.get(job.track_id) is job:
+                    del self._inflight[job.track_id]
+
+
+job_queue = JobQueue()
@@ -0,0 +1,229 @@
+"""Keeps the downloaded songs library under a disk quota.
+
+Every request for a stored file goes through `record_access`, which counts
+it in memory; a flusher thread writes the counts to `saved_songs` in batches
+every LIBRARY_PLAY_FLUSH_S (`play_count` for requests from the first byte,
+`last_played_at` for any). When the files under `songs/` outgrow
+LIBRARY_QUOTA_MB, a background pass evicts the least recently
+(LIBRARY_EVICTION=lru) or least frequently (lfu) played files until usage is
+back under LIBRARY_QUOTA_TARGET of the quota.
+
+An evicted file's rows are deleted in one statement before the file is, so
+the track is downloaded again the next time it is picked instead of being
+served as a 404. Pooled tracks and files played or downloaded in the last
+LIBRARY_PROTECT_S, as far as the catalog knows, are never evicted.
+
+Batched plays reach the catalog up to LIBRARY_PLAY_FLUSH_S late, and a pass
+only sees its own process's, so streams are protected separately:
+`record_access` also marks the file in use in the store (a marker file's
+mtime, see `audio_store.mark_in_use`), and a pass checks that marker under
+the file's store lock. A file any worker served in the last
+LIBRARY_STREAM_LEASE_S is kept, so a player that pauses and then asks for the
+next range still finds it. A response that already has the file open is not
+affected by the unlink either.
+"""
+import atexit
+import os
+import threading
+import time
+
+from filelock import FileLock, Timeout
+
+import audio_store
+import db
+import transcode
+
+# 0 turns eviction off; plays are recorded either way
+LIBRARY_QUOTA_MB = float(os.getenv('LIBRARY_QUOTA_MB', '0'))
+# Once over quota, evict down to this fraction of it so every new download doesn't trigger a pass
+LIBRARY_QUOTA_TARGET = float(os.getenv('LIBRARY_QUOTA_TARGET', '0.9'))
+LIBRARY_EVICTION = os.getenv('LIBRARY_EVICTION', 'lru').lower()
+LIBRARY_EVICT_INTERVAL_S = float(os.getenv('LIBRARY_EVICT_INTERVAL_S', '300'))
+# Files used (or downloaded) more recently than this are kept even over quota
+LIBRARY_PROTECT_S = float(os.getenv('LIBRARY_PROTECT_S', '900'))
+# Keep well below LIBRARY_PROTECT_S: unflushed plays are invisible to other processes' passes
+LIBRARY_PLAY_FLUSH_S = float(os.getenv('LIBRARY_PLAY_FLUSH_S', '5'))
+# A file served this recently counts as still being streamed (a paused player resumes with a range request)
+LIBRARY_STREAM_LEASE_S = float(os.getenv('LIBRARY_STREAM_LEASE_S', '3600'))
+
+if LIBRARY_EVICTION not in db.EVICTION_POLICIES:
+    raise ValueError(f"LIBRARY_EVICTION must be one of: {', '.join(db.EVICTION_POLICIES)}")
+
+
+def stored_key(path):
+    """Catalog `file_path` a request for `path` (absolute, or relative to songs/) counts towards.
+
+    Renditions count towards their original. None for paths outside the store.
+    """
+    if os.path.isabs(path):
+        rel = os.path.relpath(path, audio_store.SONGS_DIR)
+        if rel.startswith('..'):
+            return None
+        path = rel.replace(os.sep, '/')
+    if audio_store.is_variant_key(path):
+        return audio_store.key_for(path.split('/')[2])
+    return path
+
+
+def is_play(path, range_header=None):
+    """Whether a request starts a play, rather than continuing one (later ranges, HLS segments)."""
+    if path.endswith('.ts') or (path.endswith('.m3u8') and not path.endswith(transcode.MASTER_PLAYLIST)):
+        return False
+    return not range_header or range_header.replace(' ', '').startswith('bytes=0-')
+
+
+class LibraryManager:
+    def __init__(self, quota_bytes=LIBRARY_QUOTA_MB * 1024 * 1024, policy=LIBRARY_EVICTION,
+                 interval=LIBRARY_EVICT_INTERVAL_S):
+        self.quota_bytes = int(quota_bytes)
+        self.policy = policy
+        self.interval = interval
+        self.last_stats = None
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._thread = None
+
+    # --- plays -----------------------------------------------------------------
+
+    def record_access(self, path, range_header=None):
+        """Count a request for a stored file and mark the file in use.
+
+        The count is written to the catalog by the next flush; the in-use
+        marker is a filesystem touch, never a database write.
+        """
+        key = stored_key(path)
+        if key is None:
+            return
+        try:
+            audio_store.mark_in_use(key)
+        except OSError as e:
+            print(f"[library] failed to mark {key} in use: {e}")
+        play = is_play(path, range_header)
+        with self._lock:
+            count, _ = self._pending.get(key, (0, 0.0))
+            self._pending[key] = (count + (1 if play else 0), time.time())
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='library-plays', daemon=True)
+                self._flusher.start()
+
+    def flush(self):
+        """Write the plays recorded since the last flush in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            db.record_plays([(count, at, key) for key, (count, at) in pending.items()])
+        except Exception as e:
+            print(f"[library] failed to record {len(pending)} plays: {e}")
+            with self._lock:
+                # Keep them for the next flush, merged with anything recorded meanwhile
+                for key, (count, at) in pending.items():
+                    newer_count, newer_at = self._pending.get(key, (0, 0.0))
+                    self._pending[key] = (count + newer_count, max(at, newer_at))
+            return 0
+        return len(pending)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(LIBRARY_PLAY_FLUSH_S)
+            self.flush()
+
+    # --- eviction --------------------------------------------------------------
+
+    def start(self):
+        if self.quota_bytes <= 0:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='library-evict', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                stats = self.enforce_quota()
+                if stats is not None:
+                    self.last_stats = stats
+                    if stats['evicted_files']:
+                        print(f"[library] evicted: {stats}")
+            except Exception as e:
+                print(f"[library] eviction failed: {e}")
+            time.sleep(self.interval)
+
+    def enforce_quota(self):
+        """One eviction pass. Returns what it did, or None if another process is running one."""
+        os.makedirs(audio_store.LOCKS_DIR, exist_ok=True)
+        # One pass at a time across worker processes sharing the store
+        lock = FileLock(os.path.join(audio_store.LOCKS_DIR, 'library-evict.lock'))
+        try:
+            lock.acquire(timeout=0)
+        except Timeout:
+            return None
+        try:
+            return self._evict()
+        finally:
+            lock.release()
+
+    def _evict(self):
+        # Plays still in memory must count before anything is judged unused
+        self.flush()
+        usage = audio_store.disk_usage()
+        stats = {'usage_bytes': usage, 'quota_bytes': self.quota_bytes, 'evicted_files': 0,
+                 'evicted_rows': 0, 'freed_bytes': 0, 'skipped_protected': 0, 'skipped_streaming': 0}
+        if usage <= self.quota_bytes:
+            return stats
+        target = int(self.quota_bytes * LIBRARY_QUOTA_TARGET)
+        now = time.time()
+        used_before = now - LIBRARY_PROTECT_S
+        seen = set()
+        while usage > target:
+            # Files skipped earlier in this pass come back from the query; look past them
+            candidates = [row for row in db.eviction_candidates(self.policy, used_before, limit=len(seen) + 100)
+                          if row['file_path'] not in seen]
+            if not candidates:
+                break
+            for row in candidates:
+                file_path = row['file_path']
+                seen.add(file_path)
+                with audio_store.store_lock(file_path):
+                    served_at = audio_store.in_use_since(file_path)
+                    if served_at is not None and served_at > now - LIBRARY_STREAM_LEASE_S:
+                        stats['skipped_streaming'] += 1
+                        continue
+                    rows = db.evict_file(file_path, used_before)
+                    if not rows:
+                        stats['skipped_protected'] += 1
+                        continue
+                    freed = audio_store.remove(file_path)
+                usage -= freed
+                stats['evicted_files'] += 1
+                stats['evicted_rows'] += rows
+                stats['freed_bytes'] += freed
+                if usage <= target:
+                    break
+        stats['usage_bytes'] = usage
+        with self._lock:
+            self.evicted_files += stats['evicted_files']
+            self.evicted_bytes += stats['freed_bytes']
+        return stats
+
+    def status(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'quota_bytes': self.quota_bytes,
+            'policy': self.policy,
+            'pending_plays': pending,
+            'evicted_files_total': self.evicted_files,
+            'evicted_bytes_total': self.evicted_bytes,
+            'last_pass': self.last_stats,
+        }
+
+
+library = LibraryManager()
+# Plays recorded just before a clean shutdown still reach the catalog
+atexit.register(library.flush)
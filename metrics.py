@@ -0,0 +1,167 @@
+"""In-process metrics: stage latency histograms, counters and Server-Timing.
+
+`timed(stage)` measures a block of work into the `hwgide_stage_seconds`
+histogram and, while a request is being handled, into that request's
+Server-Timing list. The current request lives in a context variable, so this
+works per thread under Flask and per task under the ASGI app.
+`render()` produces the Prometheus text exposition format for `/metrics`;
+values that other modules already count (cache hit/miss numbers, batcher
+stats) are pulled in at scrape time through `register_collector`.
+
+Everything is per process; with several workers each one reports its own.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_collectors = []
+# (started, [(stage, seconds), ...]) of the request being handled, if any
+_request = contextvars.ContextVar('metrics_request', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = (('le', _number(bound)),)
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+stage_seconds = Histogram('hwgide_stage_seconds', 'Time spent in each pipeline stage.', ('stage',))
+request_seconds = Histogram('hwgide_http_request_seconds', 'HTTP request handling time (until the response starts).',
+                            ('endpoint', 'method', 'status'))
+downloads_total = Counter('hwgide_downloads_total', 'Track fetches by outcome.', ('outcome',))
+
+
+def register_collector(fn):
+    """`fn()` returns [(name, type, help, [(labels_dict, value), ...]), ...] at scrape time."""
+    _collectors.append(fn)
+    return fn
+
+
+def begin_request():
+    _request.set((time.perf_counter(), []))
+
+
+def end_request():
+    """Return (total_seconds, [(stage, seconds), ...]) for the current request."""
+    current = _request.get()
+    _request.set(None)
+    if current is None:
+        return 0.0, []
+    started, timings = current
+    return time.perf_counter() - started, timings
+
+
+def record(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+    current = _request.get()
+    if current is not None:
+        current[1].append((stage, seconds))
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def server_timing(total, timings):
+    """Server-Timing header value; repeated stages are summed and keep their first position."""
+    merged = {}
+    for stage, seconds in timings:
+        merged[stage] = merged.get(stage, 0.0) + seconds
+    parts = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in merged.items()]
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    for collect in list(_collectors):
+        try:
+            families = collect()
+        except Exception as e:
+            print(f"[metrics] collector {getattr(collect, '__name__', collect)} failed: {e}")
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(labels.keys(), labels.values())} {_number(value)}')
+    return '\n'.join(lines) + '\n'
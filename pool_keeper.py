@@ -0,0 +1,111 @@
+"""Keeps a few downloaded tracks ready for every emotion label.
+
+The photo endpoint claims a track from the pool (`downloads.claim_pooled`) so a
+request only costs inference plus file serving; the keeper thread of the
+process that served it downloads a replacement in the background through the
+job queue. Every worker process runs a keeper, and a per-label file lock makes
+sure only one of them refills a given label at a time.
+"""
+import os
+import threading
+
+from filelock import FileLock, Timeout
+
+import downloads
+import jobs
+import track_selection
+from emotion_model import EMOTION_LABELS
+
+EMOTION_POOL_ENABLED = os.getenv('EMOTION_POOL', '1') == '1'
+# Tracks kept ready per emotion label
+EMOTION_POOL_SIZE = int(os.getenv('EMOTION_POOL_SIZE', '3'))
+# Full sweep over all labels even when nobody asked for a refill
+EMOTION_POOL_INTERVAL_S = float(os.getenv('EMOTION_POOL_INTERVAL_S', '600'))
+# Longest a refill waits on one download before moving on
+POOL_REFILL_WAIT_S = downloads.DOWNLOAD_LOCK_TIMEOUT_S
+
+
+class PoolKeeper:
+    def __init__(self, labels=EMOTION_LABELS, size=EMOTION_POOL_SIZE, interval=EMOTION_POOL_INTERVAL_S):
+        self.labels = tuple(labels)
+        self.size = size
+        self.interval = interval
+        self._wake = threading.Event()
+        self._requested = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='pool-keeper', daemon=True)
+                self._thread.start()
+
+    def request_refill(self, label):
+        """Top up `label` soon, after a request claimed one of its tracks."""
+        with self._lock:
+            self._requested.add(label)
+        self._wake.set()
+
+    def _label_lock(self, label):
+        os.makedirs(downloads.LOCKS_DIR, exist_ok=True)
+        return FileLock(os.path.join(downloads.LOCKS_DIR, f'pool-{label}.lock'))
+
+    def _run(self):
+        print(f"[pool] keeper running in pid {os.getpid()}")
+        # Sweep every label at start and every `interval`; in between, refill what was claimed here
+        sweep, labels = True, self.labels
+        while True:
+            for label in labels:
+                try:
+                    self._refill_locked(label, sweep=sweep)
+                except Exception as e:
+                    print(f"[pool] refill for {label} failed: {e}")
+            sweep = not self._wake.wait(self.interval)
+            with self._lock:
+                self._wake.clear()
+                labels = self.labels if sweep else tuple(self._requested)
+                self._requested = set()
+
+    def _refill_locked(self, label, sweep=False):
+        lock = self._label_lock(label)
+        try:
+            # A sweep leaves a label another worker is refilling to it. A claim
+            # waits its turn, since that worker may have checked the count before it.
+            lock.acquire(timeout=0 if sweep else POOL_REFILL_WAIT_S)
+        except Timeout:
+            return
+        try:
+            self.refill(label)
+        finally:
+            lock.release()
+
+    def refill(self, label):
+        missing = self.size - downloads.pool_count(label)
+        # Bounded so a label whose playlists keep failing can't stall the others
+        attempts = missing * 3
+        while missing > 0 and attempts > 0:
+            attempts -= 1
+            try:
+                # Not a play yet: it joins the recent-play window when a request claims it
+                track = track_selection.pick_track(label, remember=False)
+            except track_selection.SelectionError as e:
+                print(f"[pool] no track for {label}: {e}")
+                return
+            job = jobs.job_queue.submit(track, label, emotion=label)
+            if not job.wait(POOL_REFILL_WAIT_S):
+                # A stuck download must not hold the label lock for good; the next sweep retries
+                print(f"[pool] {label}: gave up waiting for {track.get('id')} after {POOL_REFILL_WAIT_S:.0f}s")
+                return
+            if job.state != jobs.READY:
+                continue
+            if not downloads.add_to_pool(track, label):
+                continue
+            missing = self.size - downloads.pool_count(label)
+            print(f"[pool] {label}: added {track.get('id')} ({self.size - missing}/{self.size})")
+
+    def status(self):
+        return {label: downloads.pool_count(label) for label in self.labels}
+
+
+pool_keeper = PoolKeeper()
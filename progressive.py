@@ -0,0 +1,124 @@
+"""Streaming a track to the client while spotdl is still producing it.
+
+spotdl's ffmpeg step appends MP3 frames to a file in the job's temp directory.
+`stream_job` tails that file and yields audio as it appears. After
+the download finishes, validation passes and the file is in the store, it
+switches to the stored copy at the same audio offset. spotdl rewrites the ID3
+tag (and so shifts the audio) when it adds metadata, so offsets are counted
+from the end of the tag; the last bytes sent are compared against the stored
+copy before splicing.
+
+A download that fails after bytes went out cannot change the status code any
+more. The stream is aborted instead (the chunked body never terminates), and
+the client can read the reason from `/jobs/<id>` and retry.
+"""
+import os
+
+import audio_serving
+import jobs
+
+# Bytes the growing file must have before streaming starts
+PROGRESSIVE_MIN_BYTES = int(os.getenv('PROGRESSIVE_MIN_BYTES', str(64 * 1024)))
+# How often the growing file is checked for new bytes
+PROGRESSIVE_POLL_S = 0.25
+# Bytes compared at the splice point between the growing and the stored file
+SPLICE_CHECK_BYTES = 4096
+
+
+class StreamAborted(Exception):
+    """The stream cannot be completed; the response must be cut off."""
+
+
+def id3_size(head):
+    """Length of the ID3v2 tag at the start of a file (0 if none), or None if
+    `head` is too short to tell."""
+    if len(head) < 3:
+        return None
+    if head[:3] != b'ID3':
+        return 0
+    if len(head) < 10:
+        return None
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _partial_bytes(job):
+    try:
+        return os.path.getsize(job.partial_path) if job.partial_path else 0
+    except OSError:
+        return 0
+
+
+def wait_until_streamable(job, timeout):
+    """Block until the job's growing file has PROGRESSIVE_MIN_BYTES or the job is done.
+
+    Returns False if neither happened within `timeout` seconds.
+    """
+    waited = 0.0
+    while not job.done and _partial_bytes(job) < PROGRESSIVE_MIN_BYTES:
+        if waited >= timeout:
+            return False
+        job.wait_for_change(job.version, PROGRESSIVE_POLL_S)
+        waited += PROGRESSIVE_POLL_S
+    return True
+
+
+def _tail(job, fh):
+    """Yield audio (everything after the ID3 tag) from the growing file until
+    spotdl stops appending to it."""
+    tag = None
+    sent = 0
+    while True:
+        fh.seek(0)
+        size = id3_size(fh.read(10))
+        if size is not None:
+            if tag is None:
+                tag = size
+            elif size != tag:
+                # spotdl is writing its own tags; the rest comes from the stored file
+                return
+            fh.seek(tag + sent)
+            chunk = fh.read(audio_serving.CHUNK_SIZE)
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+                continue
+        if job.state != jobs.DOWNLOADING:
+            return
+        job.wait_for_change(job.version, PROGRESSIVE_POLL_S)
+
+
+def stream_job(job):
+    """Generator of MP3 bytes for `job`; raises StreamAborted if it cannot finish."""
+    sent = 0
+    tail = b''
+    if job.partial_path and not job.done:
+        try:
+            fh = open(job.partial_path, 'rb')
+        except OSError:
+            fh = None
+        if fh is not None:
+            with fh:
+                for chunk in _tail(job, fh):
+                    sent += len(chunk)
+                    tail = (tail + chunk)[-SPLICE_CHECK_BYTES:]
+                    yield chunk
+
+    job.wait()
+    if job.state == jobs.FAILED:
+        print(f"[progressive] job {job.id} failed after {sent} bytes: {job.error}")
+        raise StreamAborted(job.error)
+
+    with open(job.result['audio_path'], 'rb') as fh:
+        tag = id3_size(fh.read(10)) or 0
+        if sent:
+            fh.seek(tag + sent - len(tail))
+            if fh.read(len(tail)) != tail:
+                print(f"[progressive] job {job.id}: stored file does not continue the streamed bytes")
+                raise StreamAborted('stored file does not match the streamed prefix')
+            fh.seek(tag + sent)
+        else:
+            fh.seek(0)
+        for chunk in iter(lambda: fh.read(audio_serving.CHUNK_SIZE), b''):
+            yield chunk
@@ -0,0 +1,203 @@
+"""Spotify Web API client for the asyncio (ASGI) request path.
+
+Does what spotify_client.py does for the Flask handlers, on one pooled
+`httpx.AsyncClient`, so a request waiting on Spotify holds no thread. Both
+clients share the search and playlist caches, so a query answered on one path
+is cached for the other, and concurrent misses for the same search or pool
+wait on one request instead of each asking Spotify. The client-credentials
+token is refreshed TOKEN_REFRESH_MARGIN_S before it expires by a background
+task, while callers keep using the current one.
+"""
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+import metrics
+import spotify_client
+import track_selection
+from spotify_client import (
+    CLIENT_ID, CLIENT_SECRET, PLAYLIST_MAX_TRACKS, PLAYLIST_PAGE_SIZE, PLAYLIST_TRACK_FIELDS,
+    SPOTIFY_API_PREFIX, SPOTIFY_BACKOFF, SPOTIFY_FETCH_WORKERS, SPOTIFY_MAX_RETRY_AFTER_S, SPOTIFY_POOL_SIZE,
+    SPOTIFY_RETRIES, SPOTIFY_TIMEOUT_S, SPOTIFY_TOKEN_URL, TOKEN_REFRESH_MARGIN_S,
+)
+
+_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Statuses whose Retry-After header is honoured, as urllib3's Retry does for spotify_client
+_RETRY_AFTER_STATUSES = frozenset((429, 503))
+
+
+def _retry_after(response):
+    """Seconds the Retry-After header asks for (delta or HTTP date), or None if absent or invalid."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class SpotifyAsync:
+    """Created inside the running event loop; its connections and locks belong to that loop."""
+
+    def __init__(self):
+        self._http = httpx.AsyncClient(
+            timeout=SPOTIFY_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=SPOTIFY_POOL_SIZE, max_keepalive_connections=SPOTIFY_POOL_SIZE),
+        )
+        self._token = None
+        self._expires_at = 0
+        self._token_lock = asyncio.Lock()
+        self._refreshing = None
+        self._fetch_slots = asyncio.Semaphore(SPOTIFY_FETCH_WORKERS)
+        # key -> task loading it, shared by every request that misses the cache meanwhile
+        self._loading = {}
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _request_token(self):
+        async with self._token_lock:
+            # another task may have refreshed while we waited
+            if self._token and self._expires_at - time.time() >= TOKEN_REFRESH_MARGIN_S:
+                return self._token
+            response = await self._http.post(
+                SPOTIFY_TOKEN_URL,
+                data={'grant_type': 'client_credentials'},
+                auth=(CLIENT_ID or '', CLIENT_SECRET or ''),
+            )
+            response.raise_for_status()
+            info = response.json()
+            self._token = info['access_token']
+            self._expires_at = time.time() + int(info.get('expires_in', 3600))
+            return self._token
+
+    def _refresh_in_background(self):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._request_token())
+            self._refreshing.add_done_callback(_log_refresh_failure)
+
+    async def access_token(self):
+        remaining = self._expires_at - time.time()
+        if self._token and remaining > 0:
+            if remaining < TOKEN_REFRESH_MARGIN_S:
+                self._refresh_in_background()
+            return self._token
+        return await self._request_token()
+
+    def _single_flight(self, key, load):
+        """Await `load()` once for `key` however many requests ask for it at the same time."""
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        # A caller giving up must not cancel the load the others are waiting on
+        return asyncio.shield(task)
+
+    async def get(self, path, params=None):
+        """GET an API path (relative to SPOTIFY_API_PREFIX) with retries; returns the JSON body.
+
+        A Retry-After on 429/503 is waited out, or fails the call at once when
+        it asks for more than SPOTIFY_MAX_RETRY_AFTER_S, like spotify_client.
+        """
+        url = SPOTIFY_API_PREFIX + path
+        reauthorised = False
+        attempt = 0
+        while True:
+            delay = SPOTIFY_BACKOFF * (2 ** attempt)
+            token = await self.access_token()
+            try:
+                response = await self._http.get(url, params=params, headers={'Authorization': f'Bearer {token}'})
+            except httpx.TransportError:
+                if attempt >= SPOTIFY_RETRIES:
+                    raise
+            else:
+                if response.status_code == 401 and not reauthorised:
+                    # token revoked or expired early; fetch a new one once
+                    reauthorised = True
+                    self._token = None
+                    continue
+                retry_after = _retry_after(response) if response.status_code in _RETRY_AFTER_STATUSES else None
+                if (response.status_code not in _RETRY_STATUSES or attempt >= SPOTIFY_RETRIES
+                        or (retry_after is not None and retry_after > SPOTIFY_MAX_RETRY_AFTER_S)):
+                    response.raise_for_status()
+                    return response.json()
+                if retry_after is not None:
+                    delay = retry_after
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def search(self, q, type='track', limit=10):
+        """Async `spotify_client.search`, answered from the same cache."""
+        key = spotify_client.search_key(q, type, limit)
+        cached = spotify_client.search_cache.get(key)
+        if cached is not None:
+            return cached
+
+        async def load():
+            with metrics.timed('spotify_search'):
+                result = await self.get('search', {'q': q, 'type': type, 'limit': limit})
+            spotify_client.search_cache.set(key, result)
+            return result
+        return await self._single_flight(('search', key), load)
+
+    async def _playlist_page(self, playlist_id, offset):
+        async with self._fetch_slots:
+            return await self.get(f'playlists/{playlist_id}/tracks', {
+                'fields': PLAYLIST_TRACK_FIELDS,
+                'limit': PLAYLIST_PAGE_SIZE,
+                'offset': offset,
+                'additional_types': 'track',
+            })
+
+    async def fetch_playlists(self, playlist_ids):
+        """Async `spotify_client.fetch_playlists`: same result, caching and page order."""
+        result, missing = spotify_client.cached_playlists(playlist_ids)
+        if not missing:
+            return result
+        with metrics.timed('spotify_playlist_tracks'):
+            firsts = await asyncio.gather(*(self._playlist_page(pid, 0) for pid in missing), return_exceptions=True)
+            pages = {}
+            rest = []
+            for pid, page in zip(missing, firsts):
+                if isinstance(page, Exception):
+                    print(f"[spotify] failed to fetch playlist {pid}: {page}")
+                    continue
+                pages[pid] = [page.get('items') or []]
+                total = min(page.get('total') or 0, PLAYLIST_MAX_TRACKS)
+                rest.extend((pid, offset) for offset in range(PLAYLIST_PAGE_SIZE, total, PLAYLIST_PAGE_SIZE))
+            more = await asyncio.gather(*(self._playlist_page(pid, offset) for pid, offset in rest),
+                                        return_exceptions=True)
+        failed = set()
+        for (pid, offset), page in zip(rest, more):
+            if isinstance(page, Exception):
+                # a partial playlist is still worth sampling from, but not worth caching
+                print(f"[spotify] failed to fetch playlist {pid} at offset {offset}: {page}")
+                failed.add(pid)
+                continue
+            pages[pid].append(page.get('items') or [])
+        return spotify_client.store_playlists(pages, failed, result)
+
+    async def pick_track(self, search_query):
+        """Async `track_selection.pick_track`, sharing its pool cache and recent-play memory."""
+        pool = track_selection.cached_pool(search_query)
+        if pool is None:
+            async def load():
+                ids = track_selection.playlist_ids(await self.search(search_query, type='playlist', limit=10))
+                loaded = track_selection.pool_from_playlists(ids, await self.fetch_playlists(ids))
+                track_selection.store_pool(search_query, loaded)
+                return loaded
+            pool = await self._single_flight(('pool', search_query), load)
+        return track_selection.pick_from(pool)
+
+
+def _log_refresh_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[spotify] background token refresh failed: {task.exception()}")
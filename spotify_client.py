@@ -0,0 +1,288 @@
+"""Process-wide Spotify client.
+
+One `spotipy.Spotify` instance is shared by every request thread. It keeps a
+pooled `requests` session (so TLS connections are reused), retries transient
+failures, and holds its client-credentials token in memory, refreshing it in
+the background before it expires.
+
+Search and playlist lookups go through `search()` / `fetch_playlists()`,
+which answer repeated queries from an in-memory TTL+LRU cache, shared with
+the asyncio client in spotify_async.py. `fetch_playlists()` reads every page
+of several playlists at once on a small bounded thread pool, asking Spotify
+only for the track fields we use.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.oauth2 import SpotifyClientCredentials
+from urllib3.exceptions import InvalidHeader, MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+import metrics
+from ttl_cache import TTLCache
+
+# Read once at import; handlers no longer call os.getenv per request
+CLIENT_ID = os.getenv('CLIENT_ID')
+CLIENT_SECRET = os.getenv('CLIENT_SECRET')
+
+# Overridable so the service can be pointed at a stand-in API (see bench/)
+SPOTIFY_API_PREFIX = os.getenv('SPOTIFY_API_PREFIX', 'https://api.spotify.com/v1/')
+SPOTIFY_TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', SpotifyClientCredentials.OAUTH_TOKEN_URL)
+
+SPOTIFY_TIMEOUT_S = float(os.getenv('SPOTIFY_TIMEOUT_S', '5'))
+SPOTIFY_RETRIES = int(os.getenv('SPOTIFY_RETRIES', '3'))
+SPOTIFY_BACKOFF = float(os.getenv('SPOTIFY_BACKOFF', '0.3'))
+# Longest Retry-After (on 429/503) that is waited out before retrying; longer ones fail the call
+SPOTIFY_MAX_RETRY_AFTER_S = float(os.getenv('SPOTIFY_MAX_RETRY_AFTER_S', '10'))
+SPOTIFY_POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', '16'))
+# Tokens are refreshed this long before Spotify says they expire
+TOKEN_REFRESH_MARGIN_S = int(os.getenv('SPOTIFY_TOKEN_REFRESH_MARGIN_S', '300'))
+
+SEARCH_CACHE_TTL_S = float(os.getenv('SPOTIFY_SEARCH_CACHE_TTL_S', '3600'))
+PLAYLIST_CACHE_TTL_S = float(os.getenv('SPOTIFY_PLAYLIST_CACHE_TTL_S', '3600'))
+SPOTIFY_CACHE_SIZE = int(os.getenv('SPOTIFY_CACHE_SIZE', '512'))
+
+# Parallel page requests made by fetch_playlists()
+SPOTIFY_FETCH_WORKERS = int(os.getenv('SPOTIFY_FETCH_WORKERS', '8'))
+# Tracks read per playlist at most (Spotify pages hold 100)
+PLAYLIST_MAX_TRACKS = int(os.getenv('SPOTIFY_PLAYLIST_MAX_TRACKS', '1000'))
+PLAYLIST_PAGE_SIZE = 100
+# Only what track selection and the responses need from each playlist item
+PLAYLIST_TRACK_FIELDS = ('total,items(track(id,name,popularity,is_local,artists(name),'
+                         'album(name,release_date,images),external_urls(spotify)))')
+
+search_cache = TTLCache(maxsize=SPOTIFY_CACHE_SIZE, ttl=SEARCH_CACHE_TTL_S, name='spotify_search')
+playlist_cache = TTLCache(maxsize=SPOTIFY_CACHE_SIZE, ttl=PLAYLIST_CACHE_TTL_S, name='spotify_playlist_tracks')
+
+_lock = threading.Lock()
+_client = None
+_refresher = None
+_fetch_pool = None
+
+
+class _EagerClientCredentials(SpotifyClientCredentials):
+    """Client-credentials flow that treats tokens as expired `TOKEN_REFRESH_MARGIN_S`
+    early and only lets one thread fetch a new token at a time."""
+
+    OAUTH_TOKEN_URL = SPOTIFY_TOKEN_URL
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+
+    def is_token_expired(self, token_info):
+        return token_info['expires_at'] - int(time.time()) < TOKEN_REFRESH_MARGIN_S
+
+    def get_access_token(self, as_dict=False, check_cache=True):
+        token_info = self.cache_handler.get_cached_token()
+        if check_cache and token_info and not self.is_token_expired(token_info):
+            return token_info if as_dict else token_info['access_token']
+        with self._token_lock:
+            # another thread may have refreshed while we waited
+            token_info = self.cache_handler.get_cached_token()
+            if not check_cache or not token_info or self.is_token_expired(token_info):
+                token_info = self._request_access_token()
+                token_info = self._add_custom_values_to_token_info(token_info)
+                self.cache_handler.save_token_to_cache(token_info)
+        return token_info if as_dict else token_info['access_token']
+
+    def seconds_until_refresh(self):
+        token_info = self.cache_handler.get_cached_token()
+        if not token_info:
+            return 0
+        return max(0, token_info['expires_at'] - int(time.time()) - TOKEN_REFRESH_MARGIN_S)
+
+
+class _SpotifyRetry(Retry):
+    """Waits out Retry-After, but gives up at once when it asks for more than
+    SPOTIFY_MAX_RETRY_AFTER_S instead of retrying early into the rate limit."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and response.status in self.RETRY_AFTER_STATUS_CODES:
+            try:
+                retry_after = self.get_retry_after(response)
+            except InvalidHeader:
+                retry_after = None
+            if retry_after is not None and retry_after > SPOTIFY_MAX_RETRY_AFTER_S:
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after:.0f}s"))
+        return super().increment(method, url, response=response, error=error, _pool=_pool,
+                                 _stacktrace=_stacktrace)
+
+
+def _build_session():
+    retry = _SpotifyRetry(
+        total=SPOTIFY_RETRIES,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=SPOTIFY_RETRIES,
+        backoff_factor=SPOTIFY_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(pool_connections=SPOTIFY_POOL_SIZE, pool_maxsize=SPOTIFY_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def credentials_configured():
+    return bool(CLIENT_ID and CLIENT_SECRET)
+
+
+def _refresh_loop(auth):
+    while True:
+        time.sleep(max(1, auth.seconds_until_refresh()))
+        try:
+            auth.get_access_token(check_cache=True)
+        except Exception as e:
+            print(f"[spotify] background token refresh failed: {e}")
+            time.sleep(10)
+
+
+def get_spotify():
+    """Return the shared Spotify client, creating it on first use."""
+    global _client, _refresher
+    if _client is not None:
+        return _client
+    with _lock:
+        if _client is None:
+            session = _build_session()
+            auth = _EagerClientCredentials(
+                client_id=CLIENT_ID,
+                client_secret=CLIENT_SECRET,
+                requests_session=session,
+                requests_timeout=SPOTIFY_TIMEOUT_S,
+                cache_handler=MemoryCacheHandler(),
+            )
+            _client = spotipy.Spotify(
+                auth_manager=auth,
+                requests_session=session,
+                requests_timeout=SPOTIFY_TIMEOUT_S,
+                retries=SPOTIFY_RETRIES,
+                status_retries=SPOTIFY_RETRIES,
+                backoff_factor=SPOTIFY_BACKOFF,
+            )
+            _client.prefix = SPOTIFY_API_PREFIX
+            _refresher = threading.Thread(target=_refresh_loop, args=(auth,), name='spotify-token', daemon=True)
+            _refresher.start()
+    return _client
+
+
+def search_key(q, type='track', limit=10):
+    return (q.strip().lower(), type, limit)
+
+
+def search(q, type='track', limit=10):
+    """Cached `sp.search`. Results are shared between callers and must not be mutated."""
+    key = search_key(q, type, limit)
+
+    def load():
+        with metrics.timed('spotify_search'):
+            return get_spotify().search(q=q, type=type, limit=limit)
+    return search_cache.get_or_load(key, load)
+
+
+def _fetch_executor():
+    global _fetch_pool
+    if _fetch_pool is None:
+        with _lock:
+            if _fetch_pool is None:
+                _fetch_pool = ThreadPoolExecutor(max_workers=SPOTIFY_FETCH_WORKERS, thread_name_prefix='spotify-fetch')
+    return _fetch_pool
+
+
+def _playlist_page(playlist_id, offset):
+    return get_spotify().playlist_items(
+        playlist_id,
+        fields=PLAYLIST_TRACK_FIELDS,
+        limit=PLAYLIST_PAGE_SIZE,
+        offset=offset,
+        additional_types=('track',),
+    )
+
+
+def fetch_playlists(playlist_ids):
+    """All tracks (up to PLAYLIST_MAX_TRACKS each) of every playlist in `playlist_ids`.
+
+    Returns {playlist_id: [track, ...]}; playlists that fail to load are left
+    out. First pages are requested together, then every remaining page of
+    every playlist, so no worker ever waits on another. Results are cached per
+    playlist and must not be mutated.
+    """
+    result, missing = cached_playlists(playlist_ids)
+    if not missing:
+        return result
+    with metrics.timed('spotify_playlist_tracks'):
+        return _fetch_missing(missing, result)
+
+
+def _fetch_missing(missing, result):
+    pool = _fetch_executor()
+    first = {pid: pool.submit(_playlist_page, pid, 0) for pid in missing}
+    pages = {}
+    rest = []
+    for pid, future in first.items():
+        try:
+            page = future.result()
+        except Exception as e:
+            print(f"[spotify] failed to fetch playlist {pid}: {e}")
+            continue
+        pages[pid] = [page.get('items') or []]
+        total = min(page.get('total') or 0, PLAYLIST_MAX_TRACKS)
+        for offset in range(PLAYLIST_PAGE_SIZE, total, PLAYLIST_PAGE_SIZE):
+            rest.append((pid, offset, pool.submit(_playlist_page, pid, offset)))
+
+    failed = set()
+    for pid, offset, future in rest:
+        try:
+            pages[pid].append(future.result().get('items') or [])
+        except Exception as e:
+            # a partial playlist is still worth sampling from, but not worth caching
+            print(f"[spotify] failed to fetch playlist {pid} at offset {offset}: {e}")
+            failed.add(pid)
+
+    return store_playlists(pages, failed, result)
+
+
+def cached_playlists(playlist_ids):
+    """Split `playlist_ids` into ({id: cached tracks}, [ids still to fetch])."""
+    result = {}
+    missing = []
+    for playlist_id in dict.fromkeys(playlist_ids):
+        cached = playlist_cache.get(('all', playlist_id))
+        if cached is not None:
+            result[playlist_id] = cached
+        else:
+            missing.append(playlist_id)
+    return result, missing
+
+
+def store_playlists(pages, failed, result):
+    """Turn {playlist_id: [page items, ...]} into track lists in `result`, caching complete ones."""
+    for pid, chunks in pages.items():
+        tracks = [item['track'] for chunk in chunks for item in chunk
+                  if item and item.get('track') and not item['track'].get('is_local')]
+        if pid not in failed:
+            playlist_cache.set(('all', pid), tracks)
+        result[pid] = tracks
+    return result
+
+
+def cache_stats():
+    return {'search': search_cache.stats(), 'playlist_tracks': playlist_cache.stats()}
+
+
+def reset():
+    """Drop the shared client (e.g. after fork) so the next call builds a fresh one."""
+    global _client, _refresher, _fetch_pool
+    with _lock:
+        _client = None
+        _refresher = None
+        _fetch_pool = None
@@ -0,0 +1,174 @@
+"""Responses shared by the inference and download route groups.
+
+Both hand a picked track to the download job queue and answer with its JSON
+metadata, a 202 pointing at the job, or the audio itself (whole or while it
+is still downloading).
+"""
+import os
+
+from flask import Response, jsonify, request
+
+from audio_serving import send_audio
+import downloads
+import jobs
+import library
+import metrics
+import progressive
+import spotify_client
+import track_selection
+
+# Longest a client may block on GET /jobs/<id>/audio?wait=
+MAX_JOB_WAIT_S = float(os.getenv('MAX_JOB_WAIT_S', '25'))
+# For clients that send `Prefer: respond-async`: longest a synchronous request holds
+# its thread waiting for a download before answering 202 with the job's URLs instead.
+# Everyone else (X-Return-Audio, the shipped web client) waits for the download.
+SYNC_DOWNLOAD_WAIT_S = float(os.getenv('SYNC_DOWNLOAD_WAIT_S', '3'))
+
+
+@metrics.register_collector
+def _cache_metrics():
+    caches = [*spotify_client.cache_stats().values(), track_selection.cache_stats()]
+    families = []
+    for field in ('hits', 'misses', 'evictions', 'expirations'):
+        families.append((f'hwgide_cache_{field}_total', 'counter', f'Cache {field} per in-process cache.',
+                         [({'cache': c['name']}, c[field]) for c in caches]))
+    families.append(('hwgide_cache_entries', 'gauge', 'Entries held per in-process cache.',
+                     [({'cache': c['name']}, c['size']) for c in caches]))
+    return families
+
+
+def download_track_and_prepare(track, search_query):
+    """Download a Spotify track using spotdl and ensure it's saved in the local `songs/` folder.
+    Returns a dict with metadata similar to the main route's JSON response.
+    """
+    result, error, job = fetch_via_queue(track, search_query)
+    if error:
+        return ({'error': error}, 500)
+    if result is None:
+        return (job_accepted(job), 202)
+    return (downloads.build_response(track, result, request.url_root), 200)
+
+
+def fetch_via_queue(track, search_query, emotion=None):
+    """Run the download on the bounded job pool and wait for it.
+
+    Returns (result, error, job). A client that accepts an async answer is only
+    waited on for SYNC_DOWNLOAD_WAIT_S; if the job is still running then,
+    result and error are both None and the caller should answer with
+    `job_accepted(job)`.
+    """
+    job = jobs.job_queue.submit(track, search_query, emotion=emotion)
+    with metrics.timed('download_wait'):
+        job.wait(SYNC_DOWNLOAD_WAIT_S if accepts_async() else None)
+    if job.state == jobs.FAILED:
+        return None, job.error, job
+    if not job.done:
+        return None, None, job
+    return job.result, None, job
+
+
+def wants_async():
+    return request.headers.get('X-Async') == '1' or request.args.get('async') == '1'
+
+
+def accepts_async():
+    """Whether the client follows a 202 job answer when the download is slow (RFC 7240 `Prefer`)."""
+    return 'respond-async' in request.headers.get('Prefer', '').lower()
+
+
+def queue_download(track, search_query, extra=None, emotion=None):
+    """Start a background download and answer 202 with the job's URLs."""
+    job = jobs.job_queue.submit(track, search_query, emotion=emotion)
+    return job_accepted(job, extra)
+
+
+def job_accepted(job, extra=None):
+    """202 answer pointing at a download job's status, events and audio URLs."""
+    root = request.url_root.rstrip('/')
+    body = job.to_dict()
+    body.update({
+        'status_url': f"{root}/jobs/{job.id}",
+        'events_url': f"{root}/jobs/{job.id}/events",
+        'audio_url': f"{root}/jobs/{job.id}/audio",
+    })
+    body.update(extra or {})
+    response = jsonify(body)
+    response.status_code = 202
+    response.headers['Location'] = body['status_url']
+    return response
+
+
+def set_track_headers(response, track, extra_headers):
+    # Attach metadata in response headers so the client can read song info when the audio
+    # is streamed directly in the POST response.
+    cover_url = ''
+    try:
+        imgs = track.get('album', {}).get('images', [])
+        if imgs:
+            cover_url = imgs[0].get('url', '')
+    except Exception:
+        cover_url = ''
+
+    response.headers['X-Track-Title'] = track.get('name') or ''
+    response.headers['X-Track-Artist'] = downloads.track_artists(track) or ''
+    response.headers['X-Track-Album'] = track.get('album', {}).get('name', '') or ''
+    response.headers['X-Track-Cover'] = cover_url or ''
+    for key, value in extra_headers.items():
+        response.headers[key] = value
+    # Allow browser JS to read our custom headers
+    response.headers['Access-Control-Expose-Headers'] = ', '.join(
+        ['X-Track-Title', 'X-Track-Artist', 'X-Track-Album', 'X-Track-Cover'] + list(extra_headers)
+    )
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+def audio_response(track, audio_path, extra_headers=None, download_name=None):
+    """Stream a downloaded track with its metadata in X-Track-* headers."""
+    library.library.record_access(audio_path, request.headers.get('Range'))
+    try:
+        response = send_audio(audio_path, download_name or os.path.basename(audio_path))
+        set_track_headers(response, track, extra_headers or {})
+        return response
+    except Exception as e:
+        print(f"[serve_audio_in_post] error: {e}")
+        return jsonify({'error': 'failed to stream audio', 'details': str(e)}), 500
+
+
+def wants_progressive():
+    return request.headers.get('X-Progressive') == '1' or request.args.get('progressive') == '1'
+
+
+def progressive_response(track, job, extra_headers=None):
+    """Stream a job's audio while spotdl is still writing it (see progressive.py).
+
+    Falls back to the finished file or a JSON error when the job is already
+    done, and to 202 + Retry-After if no audio appeared within MAX_JOB_WAIT_S.
+    """
+    extra_headers = {**(extra_headers or {}), 'X-Job-Id': job.id}
+    if not progressive.wait_until_streamable(job, MAX_JOB_WAIT_S):
+        response = jsonify(job.to_dict())
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        response.headers['Location'] = f"{request.url_root.rstrip('/')}/jobs/{job.id}/audio"
+        return response
+    if job.state == jobs.FAILED:
+        return jsonify(job.to_dict()), 500
+    if job.state == jobs.READY:
+        return audio_response(track, job.result['audio_path'], extra_headers, job.result['display_name'])
+
+    response = Response(progressive.stream_job(job), mimetype='audio/mpeg', direct_passthrough=True)
+    # Length and byte offsets are unknown until the download finishes
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['Content-Disposition'] = f'inline; filename="{downloads.track_filename(track)}"'
+    set_track_headers(response, track, extra_headers)
+    return response
+
+
+def respond_with_track(track, result, extra, extra_headers):
+    # If client requested the audio directly, stream the file in the POST response
+    if request.headers.get('X-Return-Audio') == '1' and os.path.exists(result['audio_path']):
+        return audio_response(track, result['audio_path'], extra_headers, result['display_name'])
+
+    return jsonify({**downloads.build_response(track, result, request.url_root), **extra})
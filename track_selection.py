@@ -0,0 +1,186 @@
+"""Choosing a track for a search query (an emotion label) from Spotify playlists.
+
+All tracks of every playlist the search returns are merged into one
+deduplicated candidate set, filtered once into an eligible list with a
+precomputed alias table (Walker's method), so drawing a weighted random track
+is O(1) and never loops on playlists without qualifying tracks. Eligible lists
+are cached per query alongside the Spotify lookups they were built from.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import spotify_client
+from ttl_cache import TTLCache
+
+# Tracks below this popularity, or with a curly apostrophe in the name, are never picked
+MIN_POPULARITY = int(os.getenv('SELECTION_MIN_POPULARITY', '49'))
+# Relative weight terms: base 1 + popularity/100 * W_POP + release recency * W_RECENCY
+WEIGHT_POPULARITY = float(os.getenv('SELECTION_WEIGHT_POPULARITY', '1.0'))
+WEIGHT_RECENCY = float(os.getenv('SELECTION_WEIGHT_RECENCY', '0.0'))
+RECENCY_HORIZON_YEARS = float(os.getenv('SELECTION_RECENCY_HORIZON_YEARS', '20'))
+# Tracks handed out among the last N selections are avoided when possible
+RECENT_WINDOW = int(os.getenv('SELECTION_RECENT_WINDOW', '50'))
+# Weighted draws tried before accepting a recently played track
+SELECTION_DRAWS = int(os.getenv('SELECTION_DRAWS', '4'))
+
+_eligible_cache = TTLCache(
+    maxsize=spotify_client.SPOTIFY_CACHE_SIZE,
+    ttl=spotify_client.PLAYLIST_CACHE_TTL_S,
+    name='eligible_tracks',
+)
+_recent = deque(maxlen=max(1, RECENT_WINDOW))
+_recent_lock = threading.Lock()
+
+
+class SelectionError(Exception):
+    """No usable track could be chosen; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=404):
+        super().__init__(message)
+        self.status = status
+
+
+def is_eligible(track):
+    return bool(
+        track
+        and track.get('id')
+        and track.get('external_urls', {}).get('spotify')
+        and (track.get('popularity') or 0) >= MIN_POPULARITY
+        and "’" not in (track.get('name') or '')
+    )
+
+
+def track_weight(track, current_year=None):
+    current_year = current_year or time.gmtime().tm_year
+    weight = 1.0 + WEIGHT_POPULARITY * (track.get('popularity') or 0) / 100.0
+    if WEIGHT_RECENCY:
+        try:
+            year = int((track.get('album', {}).get('release_date') or '')[:4])
+            age = max(0, current_year - year)
+            weight += WEIGHT_RECENCY * max(0.0, 1.0 - age / RECENCY_HORIZON_YEARS)
+        except ValueError:
+            pass
+    return weight
+
+
+class WeightedPool:
+    """Eligible tracks plus an alias table for O(1) weighted sampling."""
+
+    def __init__(self, tracks, weights):
+        self.tracks = list(tracks)
+        n = len(self.tracks)
+        self._prob = [0.0] * n
+        self._alias = [0] * n
+        if not n:
+            return
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = g
+            scaled[g] = scaled[g] + scaled[s] - 1.0
+            (small if scaled[g] < 1.0 else large).append(g)
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.tracks))
+        return self.tracks[i] if rng.random() < self._prob[i] else self.tracks[self._alias[i]]
+
+
+def build_pool(tracks):
+    """Eligible tracks from `tracks`, first occurrence of each id wins."""
+    current_year = time.gmtime().tm_year
+    eligible = {}
+    for track in tracks:
+        if is_eligible(track) and track['id'] not in eligible:
+            eligible[track['id']] = track
+    eligible = list(eligible.values())
+    return WeightedPool(eligible, [track_weight(t, current_year) for t in eligible])
+
+
+def playlist_ids(search_result):
+    """Ids of the playlists in a Spotify playlist search result; raises SelectionError if none."""
+    playlists = search_result['playlists']['items']
+    ids = [p['id'] for p in playlists if p and p.get('id')]
+    if not ids:
+        raise SelectionError('No playlists found for the search query.', 404)
+    return ids
+
+
+def pool_from_playlists(ids, fetched):
+    """Pool over the tracks `fetch_playlists(ids)` returned, in playlist order."""
+    if not fetched:
+        raise SelectionError('Could not load any matching playlist from Spotify.', 502)
+    return build_pool(track for pid in ids for track in fetched.get(pid, ()))
+
+
+def _pool_key(search_query):
+    return search_query.strip().lower()
+
+
+def cached_pool(search_query):
+    return _eligible_cache.get(_pool_key(search_query))
+
+
+def store_pool(search_query, pool):
+    _eligible_cache.set(_pool_key(search_query), pool)
+
+
+def _pool_for_query(search_query):
+    def load():
+        ids = playlist_ids(spotify_client.search(search_query, type='playlist', limit=10))
+        return pool_from_playlists(ids, spotify_client.fetch_playlists(ids))
+    return _eligible_cache.get_or_load(_pool_key(search_query), load)
+
+
+def _recently_played(track_id):
+    with _recent_lock:
+        return track_id in _recent
+
+
+def mark_played(track_id):
+    with _recent_lock:
+        _recent.append(track_id)
+
+
+def choose(pool):
+    """Weighted draw from `pool`, avoiding recently played tracks within SELECTION_DRAWS tries."""
+    track = None
+    for _ in range(max(1, SELECTION_DRAWS)):
+        track = pool.sample()
+        if not _recently_played(track['id']):
+            break
+    return track
+
+
+def pick_track(search_query, remember=True):
+    """Return a Spotify track dict for `search_query` or raise SelectionError.
+
+    With remember=False (prefetching) the pick is not added to the recent-play
+    window; call `mark_played` once it is actually served.
+    """
+    return pick_from(_pool_for_query(search_query), remember)
+
+
+def pick_from(pool, remember=True):
+    """Draw from a pool built for a query and remember the pick; raises SelectionError if empty."""
+    if not len(pool):
+        raise SelectionError('No track in the matching playlists meets the selection criteria.', 404)
+    track = choose(pool)
+    if remember:
+        mark_played(track['id'])
+    return track
+
+
+def cache_stats():
+    return _eligible_cache.stats()
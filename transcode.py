@@ -0,0 +1,179 @@
+"""Lower-bitrate renditions and HLS segments of stored tracks, made with ffmpeg.
+
+After a download is ingested, `schedule()` hands its content-addressed path to
+a small background pool which writes, into a directory named after the
+original (`songs/ab/cd/<hash>/`):
+
+    <k>k.mp3                  an MP3 rendition per TRANSCODE_BITRATES entry
+    hls/<k>k/index.m3u8       AAC segments of HLS_SEGMENT_S seconds per bitrate
+    hls/master.m3u8           master playlist listing the HLS variants
+
+Everything is built in a `.part` directory and renamed into place at the end,
+so a variants directory is either complete or absent. Like the original, its
+files never change and are served as immutable. Without ffmpeg on PATH (or
+with TRANSCODE_ENABLED=0) nothing is scheduled and only the original is served.
+"""
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import audio_store
+import db
+
+FFMPEG_BIN = os.getenv('FFMPEG_BIN', 'ffmpeg')
+TRANSCODE_ENABLED = os.getenv('TRANSCODE_ENABLED', '1') == '1'
+# Rendition bitrates in kbps, lowest first
+TRANSCODE_BITRATES = sorted(int(b) for b in os.getenv('TRANSCODE_BITRATES', '64,128').split(',') if b.strip())
+HLS_SEGMENT_S = int(os.getenv('HLS_SEGMENT_S', '6'))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '1'))
+TRANSCODE_TIMEOUT_S = float(os.getenv('TRANSCODE_TIMEOUT_S', '300'))
+
+MASTER_PLAYLIST = 'hls/master.m3u8'
+MIMETYPES = {
+    '.mp3': 'audio/mpeg',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+}
+
+_lock = threading.Lock()
+_executor = None
+_inflight = set()
+_ffmpeg_path = None
+
+
+def available():
+    """True when transcoding is enabled and an ffmpeg binary can be found."""
+    global _ffmpeg_path
+    if not TRANSCODE_ENABLED:
+        return False
+    if _ffmpeg_path is None:
+        _ffmpeg_path = shutil.which(FFMPEG_BIN) or ''
+        if not _ffmpeg_path:
+            print(f"[transcode] {FFMPEG_BIN} not found; serving originals only")
+    return bool(_ffmpeg_path)
+
+
+def mimetype_for(path):
+    return MIMETYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+def is_ready(rel_path):
+    return os.path.isdir(audio_store.abs_path(audio_store.variants_key(rel_path)))
+
+
+def _ffmpeg(*args):
+    command = [_ffmpeg_path, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', *args]
+    subprocess.run(command, check=True, timeout=TRANSCODE_TIMEOUT_S,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def _master_playlist():
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for kbps in TRANSCODE_BITRATES:
+        # allow ~10% for MPEG-TS container overhead
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={kbps * 1100},CODECS="mp4a.40.2"')
+        lines.append(f'{kbps}k/index.m3u8')
+    return '\n'.join(lines) + '\n'
+
+
+def transcode(rel_path):
+    """Build the variants directory for `rel_path` unless it already exists."""
+    if not audio_store.is_content_key(rel_path) or is_ready(rel_path):
+        return
+    src = audio_store.abs_path(rel_path)
+    dest = audio_store.abs_path(audio_store.variants_key(rel_path))
+    work = f"{dest}.{os.getpid()}.{threading.get_ident()}.part"
+    shutil.rmtree(work, ignore_errors=True)
+    try:
+        os.makedirs(work)
+        for kbps in TRANSCODE_BITRATES:
+            _ffmpeg('-i', src, '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', f'{kbps}k',
+                    '-f', 'mp3', os.path.join(work, f'{kbps}k.mp3'))
+            hls_dir = os.path.join(work, 'hls', f'{kbps}k')
+            os.makedirs(hls_dir, exist_ok=True)
+            _ffmpeg('-i', src, '-map', '0:a:0', '-c:a', 'aac', '-b:a', f'{kbps}k',
+                    '-f', 'hls', '-hls_time', str(HLS_SEGMENT_S), '-hls_playlist_type', 'vod',
+                    '-hls_segment_filename', os.path.join(hls_dir, 'seg_%05d.ts'),
+                    os.path.join(hls_dir, 'index.m3u8'))
+        with open(os.path.join(work, *MASTER_PLAYLIST.split('/')), 'w', newline='\n') as fh:
+            fh.write(_master_playlist())
+        try:
+            os.rename(work, dest)
+        except OSError:
+            # another process finished the same track first
+            if not os.path.isdir(dest):
+                raise
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def built_bitrates(rel_path):
+    """Rendition bitrates present in the variants directory of `rel_path`."""
+    key = audio_store.variants_key(rel_path)
+    return [kbps for kbps in TRANSCODE_BITRATES
+            if os.path.isfile(audio_store.abs_path(f"{key}/{kbps}k.mp3"))]
+
+
+def encode_bitrates(bitrates):
+    """`saved_songs.renditions` value for a list of bitrates."""
+    return ','.join(str(kbps) for kbps in bitrates)
+
+
+def _run(rel_path):
+    try:
+        transcode(rel_path)
+        # Responses read the rendition list from the catalog instead of the variants directory
+        db.set_renditions(rel_path, encode_bitrates(built_bitrates(rel_path)))
+        print(f"[transcode] renditions ready for {rel_path}")
+    except subprocess.CalledProcessError as e:
+        print(f"[transcode] ffmpeg failed for {rel_path}: {(e.stderr or b'').decode(errors='replace').strip()}")
+    except Exception as e:
+        print(f"[transcode] failed for {rel_path}: {e}")
+    finally:
+        with _lock:
+            _inflight.discard(rel_path)
+
+
+def schedule(rel_path):
+    """Queue `rel_path` for transcoding in the background.
+
+    Returns True if its renditions are ready or being built.
+    """
+    if not available() or not audio_store.is_content_key(rel_path):
+        return False
+    if is_ready(rel_path):
+        # Identical bytes stored for another track: record the renditions on the new row too
+        db.set_renditions(rel_path, encode_bitrates(built_bitrates(rel_path)))
+        return True
+    global _executor
+    with _lock:
+        if rel_path in _inflight:
+            return True
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix='transcode')
+        _inflight.add(rel_path)
+        _executor.submit(_run, rel_path)
+    return True
+
+
+def describe(rel_path, url_root):
+    """URLs of the renditions of `rel_path`, or None if they are not built yet."""
+    if not audio_store.is_content_key(rel_path) or not is_ready(rel_path):
+        return None
+    return describe_recorded(rel_path, encode_bitrates(built_bitrates(rel_path)), url_root)
+
+
+def describe_recorded(rel_path, renditions, url_root):
+    """`describe` from a `saved_songs.renditions` value, without touching the disk."""
+    if renditions is None or not audio_store.is_content_key(rel_path):
+        return None
+    key = audio_store.variants_key(rel_path)
+    base = f"{url_root.rstrip('/')}/songs/{quote(key, safe='/')}"
+    return {
+        'renditions': [{'bitrate_kbps': int(kbps), 'url': f"{base}/{kbps}k.mp3"}
+                       for kbps in renditions.split(',') if kbps],
+        'hls_url': f"{base}/{MASTER_PLAYLIST}",
+    }
@@ -0,0 +1,11 @@
+"""Production entry point: `gunicorn -c gunicorn.conf.py` serves `wsgi:app`.
+
+The app is built in the gunicorn master (preload_app) without its background
+work. Libraries the workers share are imported here, before the fork; every
+worker then starts its own threads, TensorFlow session, SQLite connections and
+Spotify client from the `post_fork` hook in gunicorn.conf.py.
+"""
+from app_factory import create_app, preload
+
+app = create_app(start_background=False)
+preload(app.config['ROLES'])